@@ -0,0 +1,71 @@
+# Measures how many commands per second maestro.Controller can encode and write.
+# The serial port is replaced by a sink that only counts bytes, so this runs
+# without a Maestro connected.
+#
+# usage: python bench_maestro.py [seconds per test]
+import sys
+import time
+import maestro
+
+
+class CountingSink:
+    """
+    Stands in for serial.Serial, keeps a count of what was written and throws it away
+    """
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+        return len(data)
+
+    def read(self, size=1):
+        return bytes(size)
+
+    def close(self):
+        pass
+
+
+def measure(name, command, seconds):
+    """
+    Calls command in a loop for about the given time and prints the rate
+    :param name: label for the printout
+    :param command: function taking the loop index
+    :param seconds: how long to run
+    :return: commands per second
+    """
+    count = 0
+    batch = 1000
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        for i in range(batch):
+            command(i)
+        count += batch
+    rate = count / (time.perf_counter() - start)
+    print("%-24s %12.0f cmd/s" % (name, rate))
+    return rate
+
+
+def main(seconds=1.0):
+    sink = CountingSink()
+    tango = maestro.Controller(usb=sink)
+    targets = [4000 + 8 * i for i in range(256)]
+
+    measure("setTarget", lambda i: tango.setTarget(1, targets[i & 0xff]), seconds)
+    measure("setSpeed", lambda i: tango.setSpeed(1, i & 0xff), seconds)
+    measure("setAccel", lambda i: tango.setAccel(1, i & 0xff), seconds)
+    measure("setTargets (2 chans)",
+            lambda i: tango.setTargets({1: targets[i & 0xff], 2: targets[i & 0xff]}), seconds)
+    tango.enableBuffer()
+    measure("setTarget, buffered",
+            lambda i: tango.setTarget(1, targets[(i >> 4) & 0xff]), seconds)
+    print("%d writes, %d bytes, %d target writes suppressed"
+          % (sink.writes, sink.bytes, tango.writesSuppressed))
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
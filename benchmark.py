@@ -0,0 +1,73 @@
+# Replays the frames in images/, or a .frames recording, through the line
+# follow loop with a simulated Maestro and reports frames per second, the
+# latency percentiles of each pipeline stage and of the serial writes, and
+# the motor commands sent per second.
+# Needs no camera, Maestro or display.
+#
+# usage: python benchmark.py [frames] [image directory or recording]
+import itertools
+import os
+import sys
+import time
+import maestro
+from metrics import Metrics
+from maestro_sim import SimulatedMaestro
+from movement import LineFollow
+from pipeline import FramePipeline
+from frame_source import open_source
+
+
+def run(source, frames=300, overlay=True):
+    """
+    Runs the line follow loop over the frames of a source
+    :param source: FrameSource, opened with loop=True to repeat it until frames have been processed
+    :param frames: most frames to process
+    :param overlay: also draw the display overlay, as pi_cam_loop does
+    :return: dict of results
+    """
+    device = SimulatedMaestro()
+    follower = LineFollow(controller=maestro.Controller(usb=device), window=False)
+    device.reset_counters()
+    metrics = Metrics(size=max(frames, 1024))
+    follower.pipeline.metrics = metrics
+    metrics.instrument_port(follower.tango)
+
+    count = 0
+    start = time.perf_counter()
+    for image in itertools.islice(source, frames):
+        count += 1
+        follower.process_frame(image)
+        if overlay:
+            follower.pipeline.get("overlay")
+        follower.perform_movement()
+        # the sample images are not of a path, keep the off-path check from ending the run
+        follower.end_count = 0
+    elapsed = time.perf_counter() - start
+
+    return {
+        "frames": count,
+        "seconds": elapsed,
+        "fps": count / elapsed,
+        "latency": metrics.snapshot()["latency"],
+        "commands_per_second": device.command_count / elapsed,
+        "bytes_per_second": device.bytes_received / elapsed,
+        "writes_suppressed": follower.tango.writesSuppressed,
+    }
+
+
+def report(results):
+    print("%d frames in %.2f s, %.1f frames/s" % (results["frames"], results["seconds"], results["fps"]))
+    print("  %-12s %8s %8s %8s %8s   ms" % ("", "mean", "p50", "p95", "p99"))
+    for name in FramePipeline.STAGES + ("serial_write",):
+        s = results["latency"].get(name)
+        if s and s["count"]:
+            print("  %-12s %8.3f %8.3f %8.3f %8.3f" % (name, s["mean_ms"], s["p50_ms"], s["p95_ms"], s["p99_ms"]))
+    print("%.1f commands/s, %.0f bytes/s, %d writes suppressed"
+          % (results["commands_per_second"], results["bytes_per_second"], results["writes_suppressed"]))
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    spec = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+    with open_source(spec, loop=True) as source:
+        report(run(source, frames))
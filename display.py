@@ -0,0 +1,205 @@
+import http.server
+import os
+import threading
+import time
+import cv2 as cv
+from runtime import LatestValue
+
+
+class OverlayPublisher:
+    """
+    Sends a few of the overlay frames to a sink on its own thread, so debug output doesn't slow
+    down the control loop. Ask wants_frame before drawing an overlay, most frames are skipped
+    without drawing anything. If the sink falls behind, older frames are dropped
+    """
+
+    def __init__(self, sink, every=10, max_fps=None):
+        """
+        :param sink: PngSink, MjpegSink or anything with write(image) and close()
+        :param every: publish one frame out of this many
+        :param max_fps: publish at most this many frames per second, None for no limit
+        """
+        self.sink = sink
+        self.every = max(1, every)
+        self.min_interval = 1.0 / max_fps if max_fps else 0
+        self.frames = 0
+        self.published = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_time = None
+        self.slot = LatestValue()
+        self.thread = threading.Thread(target=self._publish, name="publish", daemon=True)
+        self.thread.start()
+
+    def wants_frame(self):
+        """
+        Counts a frame and decides if it should be published
+        :return: True if the overlay of this frame should be passed to publish
+        """
+        self.frames += 1
+        if self.frames % self.every:
+            return False
+        now = time.monotonic()
+        if self.last_time is not None and now - self.last_time < self.min_interval:
+            return False
+        self.last_time = now
+        return True
+
+    def publish(self, image):
+        """
+        Hands a frame to the publishing thread, returns right away
+        :param image: overlay to publish, copied so the caller can reuse it
+        :return:
+        """
+        self.slot.put(image.copy())
+
+    def _publish(self):
+        while True:
+            image = self.slot.get()
+            if image is None:
+                return
+            try:
+                self.sink.write(image)
+                self.published += 1
+            except OSError as e:
+                # a full disk or a closed socket shouldn't stop the robot
+                self.errors += 1
+                self.last_error = e
+
+    def close(self, timeout=2.0):
+        self.slot.close()
+        self.thread.join(timeout)
+        self.sink.close()
+
+
+class PngSink:
+    """
+    Writes each frame to overlay.png in a directory, replacing the last one, or to numbered files
+    """
+
+    def __init__(self, directory, keep=False):
+        """
+        :param directory: directory to write into, created if needed
+        :param keep: write overlay_000000.png, overlay_000001.png, ... instead of replacing overlay.png
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep = keep
+        self.count = 0
+
+    def write(self, image):
+        ok, png = cv.imencode(".png", image)
+        if not ok:
+            raise OSError("could not encode the overlay as PNG")
+        if self.keep:
+            path = os.path.join(self.directory, "overlay_%06d.png" % self.count)
+        else:
+            path = os.path.join(self.directory, "overlay.png")
+        # written next to the target and renamed, so a viewer never sees half a file
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(png.tobytes())
+        os.replace(temp, path)
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+class MjpegSink:
+    """
+    Serves the frames as an MJPEG stream over HTTP, open http://host:port/ in a browser to watch
+    """
+
+    def __init__(self, port=8090, host="127.0.0.1", quality=70):
+        """
+        :param port: port to listen on
+        :param host: address to listen on, the default only accepts local connections
+        :param quality: JPEG quality, 0 to 100
+        """
+        self.params = [cv.IMWRITE_JPEG_QUALITY, quality]
+        self.cond = threading.Condition()
+        self.jpeg = None
+        self.sequence = 0
+        self.closed = False
+        self.server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mjpeg", daemon=True)
+        self.thread.start()
+
+    def write(self, image):
+        ok, jpeg = cv.imencode(".jpg", image, self.params)
+        if not ok:
+            raise OSError("could not encode the overlay as JPEG")
+        # encoded once here and shared by every client
+        with self.cond:
+            self.jpeg = jpeg.tobytes()
+            self.sequence += 1
+            self.cond.notify_all()
+
+    def next_frame(self, sequence, timeout=1.0):
+        """
+        Waits for a frame newer than the one a client already has
+        :param sequence: sequence number of the client's last frame
+        :param timeout: seconds to wait
+        :return: (sequence, jpeg bytes), jpeg is None if there was no new frame
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.sequence != sequence or self.closed, timeout)
+            if self.sequence == sequence:
+                return sequence, None
+            return self.sequence, self.jpeg
+
+    def _handler(self):
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                self.end_headers()
+                sequence = 0
+                try:
+                    while not sink.closed:
+                        sequence, jpeg = sink.next_frame(sequence)
+                        if jpeg is None:
+                            continue
+                        self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                                         % len(jpeg))
+                        self.wfile.write(jpeg)
+                        self.wfile.write(b"\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def open_publisher(spec, every=10, max_fps=None):
+    """
+    Opens an overlay publisher from a short description
+    :param spec: "png:DIRECTORY" or "mjpeg:PORT" (or "mjpeg:HOST:PORT")
+    :param every: publish one frame out of this many
+    :param max_fps: publish at most this many frames per second
+    :return: OverlayPublisher
+    """
+    kind, _, where = spec.partition(":")
+    if kind == "png":
+        sink = PngSink(where or "overlay")
+    elif kind == "mjpeg":
+        host, _, port = where.rpartition(":")
+        sink = MjpegSink(int(port or 8090), host or "127.0.0.1")
+    else:
+        raise ValueError("unknown overlay output %r, use png:DIRECTORY or mjpeg:PORT" % spec)
+    return OverlayPublisher(sink, every, max_fps)
@@ -1,45 +1,106 @@
 # import the necessary packages
-from picamera.array import PiRGBArray
-from picamera import PiCamera
-from movement import LineFollow
+import argparse
 import time
+import resources
+from display import open_publisher
+from metrics import Metrics, open_exporter
+from movement import FaceFollow
+from vision_pool import VisionPool
+from frame_source import open_source, record
 import cv2
 
-# initialize the camera and grab a reference to the raw camera capture
-camera = PiCamera()
-w, h = 320, 240
-camera.resolution = (w, h)  # (640, 480)
-camera.framerate = 32
-rawCapture = PiRGBArray(camera, size=camera.resolution)
-
-
-path_follow = LineFollow()  # get movement directions from this class
-
-# allow the camera to warmup
-time.sleep(0.1)
-
-# capture frames from the camera
-for frame in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-    # grab the raw NumPy array representing the image, then initialize the timestamp
-    # and occupied/unoccupied text
-    image = frame.array
-    # get frame size
-    w, h = image.shape[:2]
-    # use the lower center of the image
-    x, y = w//5, h//2
-    image = image[y:y + h//4, x:x + 3*w//5]
-
-    # do one loop
-    path_follow.pi_cam_loop(image)
-    # move
-    path_follow.perform_movement()
-    # path_follow.zero_motors()
-
-    key = cv2.waitKey(1) & 0xFF
-    # clear the stream in preparation for the next frame
-    rawCapture.truncate(0)
-
-    # if the `q` key was pressed, break from the loop
-    if key == ord("q") or path_follow.end:
-        path_follow.zero_motors()
-        break
\ No newline at end of file
+parser = argparse.ArgumentParser(description="Turn the head to follow a face seen by the camera")
+parser.add_argument("source", nargs="?", default="picamera",
+                    help="picamera, a camera index, a directory of images, a .frames recording or a video file")
+parser.add_argument("--record", metavar="FILE", help="save the frames to a .frames recording")
+parser.add_argument("--realtime", action="store_true", help="play a recording at the speed it was captured")
+parser.add_argument("--profile-startup", action="store_true",
+                    help="print how long each import and component took to set up")
+parser.add_argument("--detect-every", type=int, default=10,
+                    help="run the face detector at least every this many frames, tracking in between")
+parser.add_argument("--headless", action="store_true", help="don't open a window or draw the overlay")
+parser.add_argument("--publish", metavar="OUTPUT",
+                    help="send some overlays to png:DIRECTORY or mjpeg:PORT from a separate thread")
+parser.add_argument("--publish-every", type=int, default=10, metavar="N",
+                    help="publish one overlay out of every N frames")
+parser.add_argument("--metrics", metavar="OUTPUT",
+                    help="export latencies and rates to log:SECONDS, json:FILE or http:PORT")
+parser.add_argument("--workers", type=int, default=0,
+                    help="detect faces in this many worker processes, 0 runs everything in this process")
+args = parser.parse_args()
+
+# the workers are forked before the camera starts its threads
+pool = None
+if args.workers > 0:
+    try:
+        pool = VisionPool(args.workers)
+    except (ValueError, OSError) as e:
+        print("vision workers are not available, running in one process: %s" % e)
+
+with resources.profile.timed("source " + args.source):
+    source = open_source(args.source, realtime=args.realtime)
+frames = iter(source)
+if args.record:
+    frames = record(frames, args.record)
+
+with resources.profile.timed("FaceFollow"):
+    face_follow = FaceFollow(window=not args.headless, detect_every=args.detect_every)  # get head movements from this class
+if args.publish:
+    face_follow.publisher = open_publisher(args.publish, args.publish_every)
+metrics = exporter = None
+if args.metrics:
+    metrics = Metrics()
+    metrics.instrument_port(face_follow.tango)
+    exporter = open_exporter(metrics, args.metrics)
+
+if pool is not None:
+    # faces come back in frame order, found near where the last one was
+    results = pool.map(frames, lambda: face_follow.face)
+else:
+    results = ((image, None, None) for image in frames)
+
+try:
+    # capture frames from the camera
+    for image, face, where in results:
+        start = time.perf_counter()
+        # do one loop
+        if pool is not None:
+            face_follow.process_detection(image, face, where)
+        else:
+            face_follow.process_frame(image)
+        face_follow.show(image)
+        moved = time.perf_counter()
+        # move
+        face_follow.perform_movement()
+        if metrics is not None:
+            metrics.observe("vision", moved - start)
+            metrics.observe("actuate", time.perf_counter() - moved)
+            metrics.count("frames")
+
+        if face_follow.end:
+            break
+        if args.headless:
+            # no window to read keys from, stop with Ctrl-C
+            continue
+
+        key = cv2.waitKey(1) & 0xFF
+
+        # if the `q` key was pressed, break from the loop
+        if key == ord("q"):
+            break
+except KeyboardInterrupt:
+    pass
+finally:
+    face_follow.zero_motors()
+    source.close()
+    if pool is not None:
+        pool.close()
+    if face_follow.publisher is not None:
+        face_follow.publisher.close()
+    if exporter is not None:
+        exporter.close()
+    # sends whatever is still queued for the Maestro, the neutral targets from zero_motors
+    resources.close()
+    if args.profile_startup:
+        # the controller, window and cascade are set up with the first frame, so this waits until the end
+        print(resources.profile.report())
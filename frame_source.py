@@ -0,0 +1,363 @@
+import collections
+import glob
+import os
+import struct
+import threading
+import time
+import cv2 as cv
+import numpy as np
+from runtime import LatestValue
+
+
+class FrameSource:
+    """
+    Iterable of BGR frames for the vision loop, so the loop doesn't care where the frames come from
+
+    A source may hand out frames that live in a reused buffer. By default a frame stays valid
+    until the next one is asked for. A consumer that keeps frames longer, like ThreadedRuntime,
+    calls hold_frames and then gives each frame back with release when it is done with it
+    """
+
+    auto_release = True
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self):
+        raise NotImplementedError
+
+    def hold_frames(self):
+        """
+        Keeps frames valid until they are released instead of until the next frame
+        :return: the release function to call with each frame
+        """
+        self.auto_release = False
+        return self.release
+
+    def release(self, image):
+        """
+        Gives a frame back to the source, a no-op for sources that don't reuse buffers
+        :param image: frame from this source
+        :return:
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameRing:
+    """
+    Preallocated frame buffers that the camera captures into. A buffer is taken for each
+    capture and given back once the frame is processed, so a steady capture allocates nothing
+    """
+
+    def __init__(self, shape, slots=4):
+        """
+        :param shape: shape of each buffer
+        :param slots: number of buffers
+        """
+        self.buffers = [np.empty(shape, np.uint8) for _ in range(slots)]
+        self.free = collections.deque(self.buffers)
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Takes a free buffer, waiting for one to be released if they are all in use
+        :param timeout: seconds to wait, None waits forever
+        :return: the buffer, or None if the wait timed out
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.free, timeout):
+                return None
+            return self.free.popleft()
+
+    def owner(self, image):
+        """
+        :param image: a buffer or a view of one, such as a crop
+        :return: the buffer the image lives in, None if it is not from this ring
+        """
+        for buf in self.buffers:
+            if image is buf or image.base is buf:
+                return buf
+        return None
+
+    def release(self, image):
+        """
+        Gives back the buffer of a frame, it is captured into again later
+        :param image: a buffer or a view of one
+        :return:
+        """
+        buf = self.owner(image)
+        with self.cond:
+            if buf is not None and not any(buf is b for b in self.free):
+                self.free.append(buf)
+                self.cond.notify()
+
+
+class PiCameraSource(FrameSource):
+    """
+    Frames from the Raspberry Pi camera, captured straight into the buffers of a FrameRing
+    """
+
+    def __init__(self, resolution=(320, 240), framerate=32, slots=4):
+        """
+        :param resolution: (width, height) of the frames
+        :param framerate: frames per second
+        :param slots: number of frame buffers to capture into
+        """
+        from picamera import PiCamera
+        # initialize the camera
+        self.camera = PiCamera()
+        self.camera.resolution = resolution
+        self.camera.framerate = framerate
+        width, height = resolution
+        self.size = (height, width)
+        # the camera pads frames to a multiple of 32 columns and 16 rows
+        padded = ((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3)
+        self.ring = FrameRing(padded, slots)
+        self.stopping = threading.Event()
+        self.capture_thread = None
+        # allow the camera to warmup
+        time.sleep(0.1)
+
+    def _outputs(self, ready):
+        # capture_sequence asks for the next buffer once the last one is filled
+        while not self.stopping.is_set():
+            buf = self.ring.acquire(timeout=0.5)
+            if buf is None:
+                # every buffer is still held by the consumer
+                continue
+            yield buf
+            ready.put(buf)
+
+    def _capture(self, ready):
+        try:
+            self.camera.capture_sequence(self._outputs(ready), format="bgr", use_video_port=True)
+        finally:
+            ready.close()
+
+    def frames(self):
+        # only the newest captured frame is kept, older ones go straight back to the ring
+        ready = LatestValue(on_drop=self.ring.release)
+        self.stopping.clear()
+        self.capture_thread = threading.Thread(target=self._capture, args=(ready,), daemon=True)
+        self.capture_thread.start()
+        height, width = self.size
+        last = None
+        while True:
+            buf = ready.get()
+            if buf is None:
+                return
+            if self.auto_release and last is not None:
+                self.ring.release(last)
+            last = buf
+            yield buf[:height, :width]
+
+    def release(self, image):
+        self.ring.release(image)
+
+    def close(self):
+        self.stopping.set()
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+        self.camera.close()
+
+
+class VideoCaptureSource(FrameSource):
+    """
+    Frames from a video file or a camera opened by OpenCV
+    """
+
+    def __init__(self, device):
+        """
+        :param device: path of a video file or index of a camera
+        """
+        self.capture = cv.VideoCapture(device)
+        if not self.capture.isOpened():
+            raise IOError("could not open video source %r" % (device,))
+
+    def frames(self):
+        while True:
+            ok, image = self.capture.read()
+            if not ok:
+                return
+            yield image
+
+    def close(self):
+        self.capture.release()
+
+
+class ImageDirSource(FrameSource):
+    """
+    Frames from the images in a directory, such as images/, in file name order
+    """
+
+    def __init__(self, directory, pattern="*.png", loop=False):
+        """
+        :param directory: directory to read
+        :param pattern: glob pattern of the image files
+        :param loop: start over at the first image after the last one
+        """
+        self.paths = sorted(glob.glob(os.path.join(directory, pattern)))
+        if not self.paths:
+            raise IOError("no images matching %s in %s" % (pattern, directory))
+        self.loop = loop
+        self.images = None
+
+    def frames(self):
+        # images are read once and reused, so a replay measures the vision loop and not the disk
+        if self.images is None:
+            self.images = [cv.imread(path) for path in self.paths]
+        while True:
+            for image in self.images:
+                yield image
+            if not self.loop:
+                return
+
+
+# Recorded runs are a small header followed by fixed-size records, each one
+# a capture timestamp and the raw BGR pixels, so they can be memory-mapped.
+RECORDING_MAGIC = b"FRMS"
+RECORDING_HEADER = struct.Struct("<4sIIII")
+RECORDING_HEADER_SIZE = 64
+
+
+def recording_dtype(shape):
+    """
+    :param shape: (height, width, channels) of the frames
+    :return: NumPy dtype of one record
+    """
+    return np.dtype([("timestamp", "<f8"), ("image", np.uint8, tuple(shape))])
+
+
+class FrameRecorder:
+    """
+    Writes frames to a recording that RecordedSource can replay
+    """
+
+    def __init__(self, path, shape):
+        """
+        :param path: file to write
+        :param shape: (height, width, channels) of the frames, every frame must have this shape
+        """
+        self.shape = tuple(shape)
+        if len(self.shape) == 2:
+            self.shape += (1,)
+        self.record = np.zeros(1, recording_dtype(self.shape))
+        self.file = open(path, "wb")
+        header = RECORDING_HEADER.pack(RECORDING_MAGIC, 1, *self.shape)
+        self.file.write(header.ljust(RECORDING_HEADER_SIZE, b"\0"))
+        self.count = 0
+
+    def write(self, image, timestamp=None):
+        """
+        :param image: frame to append
+        :param timestamp: capture time in seconds, now if not given
+        :return:
+        """
+        self.record["timestamp"] = time.monotonic() if timestamp is None else timestamp
+        self.record["image"][0] = image.reshape(self.shape)
+        self.file.write(self.record.tobytes())
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def record(frames, path):
+    """
+    Passes frames through while writing them to a recording
+    :param frames: iterable of frames, all the same shape
+    :param path: file to write
+    :return: generator of the same frames
+    """
+    recorder = None
+    try:
+        for image in frames:
+            if recorder is None:
+                recorder = FrameRecorder(path, image.shape)
+            recorder.write(image)
+            yield image
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+class RecordedSource(FrameSource):
+    """
+    Frames from a recording made by FrameRecorder, memory-mapped so playback reads
+    straight from the page cache without copying
+    """
+
+    def __init__(self, path, realtime=False, loop=False, speed=1.0):
+        """
+        :param path: recording to play
+        :param realtime: wait between frames as long as between their captures, otherwise play at full speed
+        :param loop: start over at the first frame after the last one
+        :param speed: with realtime, play this many times faster than the frames were captured
+        """
+        with open(path, "rb") as f:
+            magic, version, height, width, channels = RECORDING_HEADER.unpack(
+                f.read(RECORDING_HEADER.size))
+        if magic != RECORDING_MAGIC:
+            raise IOError("%s is not a frame recording" % path)
+        self.shape = (height, width, channels) if channels > 1 else (height, width)
+        self.records = np.memmap(path, recording_dtype((height, width, channels)), mode="r",
+                                 offset=RECORDING_HEADER_SIZE)
+        self.realtime = realtime
+        self.loop = loop
+        self.speed = speed
+
+    def __len__(self):
+        return len(self.records)
+
+    def frames(self):
+        images = self.records["image"]
+        timestamps = self.records["timestamp"]
+        while True:
+            start = time.monotonic()
+            for i in range(len(images)):
+                if self.realtime:
+                    delay = (timestamps[i] - timestamps[0]) / self.speed - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                yield images[i].reshape(self.shape)
+            if not self.loop:
+                return
+
+    def close(self):
+        # the map is closed when the last frame using it is released
+        self.records = None
+
+
+def open_source(spec, realtime=False, **kwargs):
+    """
+    Opens a frame source from a short description
+    :param spec: "picamera", a camera index, a directory of images, a recording (.frames) or a video file
+    :param realtime: play a recording at the speed it was captured, the other sources are live
+                     or have no timestamps and ignore it
+    :param kwargs: passed on to the source
+    :return: FrameSource
+    """
+    if spec == "picamera":
+        return PiCameraSource(**kwargs)
+    if str(spec).isdigit():
+        return VideoCaptureSource(int(spec))
+    if os.path.isdir(spec):
+        return ImageDirSource(spec, **kwargs)
+    if spec.endswith(".frames"):
+        return RecordedSource(spec, realtime=realtime, **kwargs)
+    return VideoCaptureSource(spec)
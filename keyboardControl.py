@@ -1,5 +1,10 @@
+import argparse
+import collections
+import logging
 import tkinter as tk
-import maestro                                                     
+import maestro
+import resources
+from motion import TrajectoryPlanner
 
 MOTORS = 1
 TURN = 2
@@ -11,135 +16,184 @@ SHOULDER = 6
 SHOULDER_SIDE = 7
 HAND = 11
 
+log = logging.getLogger(__name__)
 
-##def sendCommand(x):
-##    if(x == '8'):
-##        tango.setTarget(MOTOR, 6800)
-class KeyControl():
-    def __init__(self):
-        self.tango = maestro.Controller()
-        self.body = 6000
-        self.headTurn = 6000
-        self.headTilt = 6000
-        self.motors = 6000
-        self.turn = 6000
-        self.elbow = 5000
-        self.shoulder = 6000
-        self.shoulder_side = 7000
-        self.hand = 4800
-        self.tango.setTarget(TURN, self.turn)
-        self.tango.setTarget(MOTORS, self.motors)
-        self.tango.setTarget(HEADTILT, self.headTilt)
-        self.tango.setTarget(HEADTURN, self.headTurn)
-        self.tango.setTarget(BODY, self.body)
-        self.tango.setTarget(ELBOW, self.elbow)
-        self.tango.setTarget(SHOULDER, self.shoulder)
-        self.tango.setTarget(SHOULDER_SIDE, self.shoulder_side)
-        self.tango.setTarget(HAND, self.hand)
-        
-    def head(self,key):
-        print(key.keycode)
-        if key.keycode == 38:
-            self.headTurn += 200
-            if(self.headTurn > 7900):
-                self.headTurn = 7900
-            self.tango.setTarget(HEADTURN, self.headTurn)
-        elif key.keycode == 40:
-            self.headTurn -= 200
-            if(self.headTurn < 1510):
-                self.headTurn = 1510
-            self.tango.setTarget(HEADTURN, self.headTurn)
-        elif key.keycode == 25:
-            self.headTilt += 200
-            if(self.headTilt > 7900):
-                self.headTilt = 7900
-            self.tango.setTarget(HEADTILT, self.headTilt)
-        elif key.keycode == 39:
-            self.headTilt -= 200
-            if(self.headTilt < 1510):
-                self.headTilt = 1510
-            self.tango.setTarget(HEADTILT, self.headTilt)
-                
-
-
-    def waist(self, key):
-        print(key.keycode)
-        self.tango.getPosition(ELBOW)
-        if key.keycode == 54:
-            self.body += 200
-            if(self.body > 7900):
-                self.body = 7900
-            self.tango.setTarget(BODY, self.body)
-            print("waist right")
-        elif key.keycode == 52:
-            self.body -= 200
-            if(self.body < 1510):
-                self.body = 1510
-            self.tango.setTarget(BODY, self.body)
-            print ('waist left')
-        elif key.keycode == 53:
-            #self.elbow+=200
-            #self.shoulder_side-=200
-            #print(self.elbow)
-            #self.shoulder+=200
-            #print(self.shoulder)
-            self.hand +=200
-            print(self.hand)
-            self.tango.setTarget(HAND, self.hand)
-            #self.tango.setTarget(SHOULDER_SIDE, self.shoulder_side)
-            #self.tango.setTarget(ELBOW, self.elbow)
-            #self.tango.setTarget(SHOULDER,self.shoulder)
-   
-#    def elbow(self, key):
-#        print(key.keycode)
-
-    def arrow(self, key):
-        print(key.keycode)
-        if key.keycode == 116:
-            self.motors += 200
-            if(self.motors > 7900):
-                self.motors = 7900
-            print(self.motors)
-            self.tango.setTarget(MOTORS, self.motors)
-        elif key.keycode == 111:
-            self.motors -= 200
-            if(self.motors < 1510):
-                self.motors = 1510
-            print(self.motors)
-            self.tango.setTarget(MOTORS, self.motors)
-        elif key.keycode == 114:
-            self.turn += 200
-            if(self.turn > 7400):
-                self.turn = 7400
-            print(self.turn)
-            self.tango.setTarget(TURN, self.turn)
-        elif key.keycode == 113:
-            self.turn -= 200
-            if(self.turn <2110):
-                self.turn = 2110
-            print(self.turn)
-            self.tango.setTarget(TURN, self.turn)
-        
-        elif key.keycode == 65:
-            self.motors = 6000
-            self.turn = 6000
-            self.tango.setTarget(MOTORS, self.motors)
-            self.tango.setTarget(TURN, self.turn)
-
-win = tk.Tk()
-keys = KeyControl()
-
-win.bind('<Up>', keys.arrow)
-win.bind('<Left>', keys.arrow)
-win.bind('<Down>', keys.arrow)
-win.bind('<Right>', keys.arrow)
-win.bind('<space>', keys.arrow)
-win.bind('<z>', keys.waist)
-win.bind('<c>', keys.waist)
-win.bind('<w>', keys.head)
-win.bind('<s>', keys.head)
-win.bind('<a>', keys.head)
-win.bind('<d>', keys.head)
-win.bind('<x>', keys.waist)
-win.mainloop()
-keys = KeyControl()
+# A joint is a servo channel with its starting target, the step one tick of a
+# held key moves it, the range it is kept in, and the keys (Tk keysyms) that
+# move it up and down.  Joints without keys are only set at startup.
+Joint = collections.namedtuple("Joint", "channel start step min max increase decrease")
+
+JOINTS = collections.OrderedDict([
+    ("headTurn", Joint(HEADTURN, 6000, 200, 1510, 7900, "a", "d")),
+    ("headTilt", Joint(HEADTILT, 6000, 200, 1510, 7900, "w", "s")),
+    ("body", Joint(BODY, 6000, 200, 1510, 7900, "c", "z")),
+    ("hand", Joint(HAND, 4800, 200, 1510, 7900, "x", None)),
+    ("motors", Joint(MOTORS, 6000, 200, 1510, 7900, "Down", "Up")),
+    ("turn", Joint(TURN, 6000, 200, 2110, 7400, "Right", "Left")),
+    ("elbow", Joint(ELBOW, 5000, 0, 1510, 7900, None, None)),
+    ("shoulder", Joint(SHOULDER, 6000, 0, 1510, 7900, None, None)),
+    ("shoulderSide", Joint(SHOULDER_SIDE, 7000, 0, 1510, 7900, None, None)),
+])
+
+# keys that put joints back to their starting targets
+RESETS = {
+    "space": ("motors", "turn"),
+}
+
+
+class KeyControl:
+    """
+    Moves the joints in JOINTS from the keyboard
+
+    Key events only record which keys are down. A timer runs tick at a fixed rate, and every
+    held key moves its joint one step per tick, so how fast the OS repeats keys doesn't change
+    the speed or flood the port. All the joints that moved in a tick are sent in one setTargets
+
+    With glide, a held key instead sends its joint toward the end of its range at the same
+    speed, ramped by the Maestro, and releasing it stops the joint where it is. A key press is
+    then two commands however long it is held
+    """
+
+    def __init__(self, controller=None, joints=JOINTS, resets=RESETS, period=0.05, glide=False):
+        """
+        :param controller: maestro.Controller, the default port is opened if not given
+        :param joints: {name: Joint} map of the joints to control
+        :param resets: {key: names of joints} map of keys that send joints back to their start
+        :param period: seconds between ticks
+        :param glide: let the Maestro ramp held keys, see TrajectoryPlanner
+        """
+        if controller is None:
+            controller = resources.controller(channels=maestro.ROBOT_CHANNELS)
+        self.tango = controller
+        # clamped targets resend the same value, drop those writes
+        self.tango.enableBuffer()
+        self.joints = joints
+        self.resets = resets
+        self.period = period
+        # key -> (joint name, direction)
+        self.bindings = {}
+        for name, joint in joints.items():
+            if joint.increase:
+                self.bindings[joint.increase] = (name, 1)
+            if joint.decrease:
+                self.bindings[joint.decrease] = (name, -1)
+        # keys down now, and keys pressed since the last tick so a tap shorter than a tick still counts
+        self.held = set()
+        self.pressed = set()
+        self.targets = dict((name, joint.start) for name, joint in joints.items())
+        self.tango.setTargets(dict((joint.channel, joint.start) for joint in joints.values()))
+        self.planner = TrajectoryPlanner(self.tango) if glide else None
+        # name -> direction of the joints gliding now
+        self.gliding = {}
+
+    def keys(self):
+        """
+        :return: every key this control reacts to
+        """
+        return list(self.bindings) + list(self.resets)
+
+    def press(self, event):
+        self.held.add(event.keysym)
+        self.pressed.add(event.keysym)
+
+    def release(self, event):
+        self.held.discard(event.keysym)
+
+    def tick(self):
+        """
+        Moves every joint whose key is held or was pressed since the last tick and sends the
+        new targets in one write
+        :return: {channel: target} of the joints that changed
+        """
+        active = self.held | self.pressed
+        self.pressed.clear()
+        if self.planner is not None:
+            active = self.glide(active)
+        changed = {}
+        for key in active:
+            if key in self.resets:
+                for name in self.resets[key]:
+                    changed[name] = self.joints[name].start
+                    self.gliding.pop(name, None)
+                    if self.planner is not None:
+                        # back to the start at once, not with the ramp of the last glide
+                        self.planner.clear_limits([self.joints[name].channel])
+            elif key in self.bindings:
+                name, direction = self.bindings[key]
+                joint = self.joints[name]
+                target = changed.get(name, self.targets[name]) + direction * joint.step
+                changed[name] = min(max(target, joint.min), joint.max)
+        updates = {}
+        for name, target in changed.items():
+            if target != self.targets[name]:
+                self.targets[name] = target
+                updates[self.joints[name].channel] = target
+                log.debug("%s %d", name, target)
+        if updates:
+            self.tango.setTargets(updates)
+        return updates
+
+    def glide(self, active):
+        """
+        Starts a ramped move for each joint whose key is held and stops the joints whose key was let go
+        :param active: keys held or pressed since the last tick
+        :return: the keys left for a normal step, resets and short taps
+        """
+        moving = {}
+        for key in self.held:
+            if key in self.bindings:
+                name, direction = self.bindings[key]
+                moving[name] = direction
+        for name, direction in moving.items():
+            if self.gliding.get(name) != direction:
+                joint = self.joints[name]
+                goal = joint.max if direction > 0 else joint.min
+                self.planner.move({joint.channel: goal}, velocity=joint.step / self.period)
+                self.targets[name] = goal
+                self.gliding[name] = direction
+                log.debug("%s gliding to %d", name, goal)
+        stopped = [name for name in self.gliding if name not in moving]
+        if stopped:
+            positions = self.planner.stop([self.joints[name].channel for name in stopped])
+            for name in stopped:
+                self.targets[name] = positions[self.joints[name].channel]
+                del self.gliding[name]
+                log.debug("%s stopped at %d", name, self.targets[name])
+        return set(key for key in active if key not in self.held or key not in self.bindings)
+
+    def run(self, win):
+        """
+        Binds the keys to a Tk window and starts ticking, call win.mainloop() after
+        :param win: tk.Tk window that gets the key events
+        :return:
+        """
+        for key in self.keys():
+            win.bind("<KeyPress-%s>" % key, self.press)
+            win.bind("<KeyRelease-%s>" % key, self.release)
+        interval = max(1, int(self.period * 1000))
+
+        def tick():
+            self.tick()
+            win.after(interval, tick)
+
+        win.after(interval, tick)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the robot from the keyboard")
+    parser.add_argument("--rate", type=float, default=20, help="joint updates per second while a key is held")
+    parser.add_argument("--glide", action="store_true",
+                        help="let the Maestro ramp a held key's joint instead of stepping it every tick")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every target sent")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(message)s")
+
+    win = tk.Tk()
+    keys = KeyControl(period=1.0 / args.rate, glide=args.glide)
+    keys.run(win)
+    win.mainloop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
+import collections
 import serial
-from sys import version_info
+import threading
+import time
 
-PY2 = version_info[0] == 2   #Running Python 2.x?
+# Pololu protocol command bytes
+SET_TARGET = 0x04
+SET_SPEED = 0x07
+SET_ACCEL = 0x09
+GET_POSITION = 0x10
+GET_MOVING_STATE = 0x13
+SET_MULTIPLE_TARGETS = 0x1f
+STOP_SCRIPT = 0x24
+RESTART_SCRIPT = 0x27
 
 #
 #---------------------------
@@ -28,11 +38,21 @@ class Controller:
     # assumes.  If two or more controllers are connected to different serial
     # ports, or you are using a Windows OS, you can provide the tty port.  For
     # example, '/dev/ttyACM2' or for Windows, something like 'COM3'.
-    def __init__(self,ttyStr='/dev/ttyACM0',device=0x0c):
+    # An already open port, or anything with the same write/read methods, can be
+    # passed as usb instead.
+    def __init__(self,ttyStr='/dev/ttyACM0',device=0x0c,usb=None):
         # Open the command port
-        self.usb = serial.Serial(ttyStr)
+        if usb is None:
+            usb = serial.Serial(ttyStr)
+        self.usb = usb
         # Command lead-in and device number are sent for each Pololu serial command.
-        self.PololuCmd = chr(0xaa) + chr(device)
+        self.PololuCmd = bytes(bytearray((0xaa, device)))
+        # Commands are packed into this preallocated buffer and written from a view
+        # of it, so sending a command allocates nothing.  The largest write is every
+        # channel as its own Set Target command.
+        self.txBuf = bytearray(6 * 24)
+        self.txView = memoryview(self.txBuf)
+        self.valuePkt = bytearray(self.PololuCmd + bytes(4))
         # Track target position for each servo. The function isMoving() will
         # use the Target vs Current servo position to determine if movement is
         # occuring.  Upto 24 servos on a Maestro, (0-23). Targets start at 0.
@@ -40,18 +60,69 @@ class Controller:
         # Servo minimum and maximum targets can be restricted to protect components.
         self.Mins = [0] * 24
         self.Maxs = [0] * 24
+        # Last target written to each servo, None until the first write.
+        self.Sent = [None] * 24
+        # Optional command buffer, see enableBuffer.  Pending holds targets waiting
+        # for the next flush, at most one per channel.
+        self.buffering = False
+        self.flushWindow = 0
+        self.Pending = {}
+        self.flushTimer = None
+        # Count target writes sent and target writes dropped by the buffer
+        self.writesSent = 0
+        self.writesSuppressed = 0
+        # Serializes access to the serial port and the buffer between threads.
+        # Controllers chained on one SharedPort use the port's lock, so a query
+        # and its reply can't be split by another device's query.
+        self.lock = getattr(usb, 'portLock', None) or threading.RLock()
+        # Cached servo positions, see StateMirror
+        self.mirror = None
+        # Every target written is also logged here when set, see telemetry.TelemetryLog
+        self.telemetry = None
         
     # Cleanup by closing USB serial port
     def close(self):
+        if self.mirror is not None:
+            self.mirror.stop()
+        self.flush()
         self.usb.close()
 
-    # Send a Pololu command out the serial port
+    # Send a Pololu command out the serial port.  cmd is the command byte
+    # followed by its data bytes.
     def sendCmd(self, cmd):
-        cmdStr = self.PololuCmd + cmd
-        if PY2:
-            self.usb.write(cmdStr)
-        else:
-            self.usb.write(bytes(cmdStr,'latin-1'))
+        with self.lock:
+            n = self.packHeader(0)
+            self.txBuf[n:n + len(cmd)] = cmd
+            self.usb.write(self.txView[:n + len(cmd)])
+
+    # Send a command with a channel and a 14 bit value, such as Set Target.
+    # This is the hot path, the packet already holds the lead-in and device
+    # number so only the last four bytes are filled in.
+    def sendValueCmd(self, cmd, chan, value):
+        pkt = self.valuePkt
+        with self.lock:
+            pkt[2] = cmd
+            pkt[3] = chan
+            pkt[4] = value & 0x7f #7 bits for least significant byte
+            pkt[5] = (value >> 7) & 0x7f #shift 7 and take next 7 bits for msb
+            self.usb.write(pkt)
+
+    # Pack the command lead-in and device number into txBuf at offset,
+    # returns the offset after it
+    def packHeader(self, offset):
+        self.txBuf[offset:offset + 2] = self.PololuCmd
+        return offset + 2
+
+    # Pack a command with a channel and a 14 bit value into txBuf at offset,
+    # returns the offset after it
+    def packValueCmd(self, offset, cmd, chan, value):
+        buf = self.txBuf
+        offset = self.packHeader(offset)
+        buf[offset] = cmd
+        buf[offset + 1] = chan
+        buf[offset + 2] = value & 0x7f #7 bits for least significant byte
+        buf[offset + 3] = (value >> 7) & 0x7f #shift 7 and take next 7 bits for msb
+        return offset + 4
 
     # Set channels min and max value range.  Use this as a safety to protect
     # from accidentally moving outside known safe parameters. A setting of 0
@@ -80,40 +151,154 @@ class Controller:
     # Typcially valid servo range is 3000 to 9000 quarter-microseconds
     # If channel is configured for digital output, values < 6000 = Low ouput
     def setTarget(self, chan, target):
+        target = self.clampTarget(chan, target)
+        if self.buffering:
+            self.bufferTarget(chan, target)
+        else:
+            self.sendValueCmd(SET_TARGET, chan, target)
+            self.Sent[chan] = target
+            self.writesSent += 1
+            if self.telemetry is not None:
+                self.telemetry.log_target(chan, target)
+        # Record Target value
+        self.Targets[chan] = target
+
+    # Set several channels at once from a {chan: target, ...} dict.  Each target is
+    # constrained within Min and Max range, as in setTarget.  Runs of contiguous
+    # channels are sent as one Set Multiple Targets command (not available on the
+    # Micro Maestro) and everything goes out in a single serial write.
+    def setTargets(self, targets):
+        targets = dict((chan, self.clampTarget(chan, targets[chan])) for chan in targets)
+        if self.buffering:
+            # queued together so a window of 0 still sends them in one write
+            with self.lock:
+                for chan in targets:
+                    self.queueTarget(chan, targets[chan])
+                self.scheduleFlush()
+        else:
+            self.writeTargets(targets)
+        # Record Target values
+        for chan in targets:
+            self.Targets[chan] = targets[chan]
+
+    # Write already clamped targets in a single serial write, merging contiguous
+    # channels into Set Multiple Targets commands.
+    def writeTargets(self, targets):
+        if not targets:
+            return
+        chans = sorted(targets)
+        with self.lock:
+            buf = self.txBuf
+            n = 0
+            start = 0
+            while start < len(chans):
+                # find the end of this run of contiguous channels
+                end = start + 1
+                while end < len(chans) and chans[end] == chans[end - 1] + 1:
+                    end += 1
+                if end - start == 1:
+                    n = self.packValueCmd(n, SET_TARGET, chans[start], targets[chans[start]])
+                else:
+                    n = self.packHeader(n)
+                    buf[n] = SET_MULTIPLE_TARGETS
+                    buf[n + 1] = end - start
+                    buf[n + 2] = chans[start]
+                    n += 3
+                    for chan in chans[start:end]:
+                        buf[n] = targets[chan] & 0x7f
+                        buf[n + 1] = (targets[chan] >> 7) & 0x7f
+                        n += 2
+                start = end
+            self.usb.write(self.txView[:n])
+            for chan in chans:
+                self.Sent[chan] = targets[chan]
+            self.writesSent += len(chans)
+            if self.telemetry is not None:
+                for chan in chans:
+                    self.telemetry.log_target(chan, targets[chan])
+
+    # Turn on the command buffer.  While buffering, a target equal to the last
+    # target written to that channel is dropped, and within a flush window only
+    # the last target for each channel is kept.  A window of 0 sends changed
+    # targets right away, otherwise pending targets are sent together when the
+    # window ends or flush() is called.  Dropped writes are counted in
+    # writesSuppressed.
+    def enableBuffer(self, window=0):
+        with self.lock:
+            self.flushWindow = window
+            self.buffering = True
+
+    # Send anything pending and turn off the command buffer
+    def disableBuffer(self):
+        with self.lock:
+            self.flush()
+            self.buffering = False
+
+    # Queue a clamped target in the command buffer
+    def bufferTarget(self, chan, target):
+        with self.lock:
+            self.queueTarget(chan, target)
+            self.scheduleFlush()
+
+    # Add a clamped target to Pending, or drop it if the servo already has it.
+    # Call scheduleFlush after queueing.
+    def queueTarget(self, chan, target):
+        if chan in self.Pending:
+            # the pending target is replaced before it was sent
+            self.writesSuppressed += 1
+            del self.Pending[chan]
+        if target == self.Sent[chan]:
+            # the servo already has this target
+            self.writesSuppressed += 1
+            return
+        self.Pending[chan] = target
+
+    # Send pending targets now with a window of 0, otherwise when the window ends
+    def scheduleFlush(self):
+        if not self.Pending:
+            return
+        if self.flushWindow <= 0:
+            self.flush()
+        elif self.flushTimer is None:
+            self.flushTimer = threading.Timer(self.flushWindow, self.flush)
+            self.flushTimer.daemon = True
+            self.flushTimer.start()
+
+    # Send all pending targets in one write
+    def flush(self):
+        with self.lock:
+            if self.flushTimer is not None:
+                self.flushTimer.cancel()
+                self.flushTimer = None
+            pending = self.Pending
+            self.Pending = {}
+            if pending:
+                self.writeTargets(pending)
+
+    # Constrain a target within the channel's Min and Max range, if set
+    def clampTarget(self, chan, target):
         # if Min is defined and Target is below, force to Min
         if self.Mins[chan] > 0 and target < self.Mins[chan]:
             target = self.Mins[chan]
         # if Max is defined and Target is above, force to Max
         if self.Maxs[chan] > 0 and target > self.Maxs[chan]:
             target = self.Maxs[chan]
-        #    
-        lsb = target & 0x7f #7 bits for least significant byte
-        msb = (target >> 7) & 0x7f #shift 7 and take next 7 bits for msb
-        cmd = chr(0x04) + chr(chan) + chr(lsb) + chr(msb)
-        self.sendCmd(cmd)
-        # Record Target value
-        self.Targets[chan] = target
-        
+        return target
+
     # Set speed of channel
     # Speed is measured as 0.25microseconds/10milliseconds
     # For the standard 1ms pulse width change to move a servo between extremes, a speed
     # of 1 will take 1 minute, and a speed of 60 would take 1 second.
     # Speed of 0 is unrestricted.
     def setSpeed(self, chan, speed):
-        lsb = speed & 0x7f #7 bits for least significant byte
-        msb = (speed >> 7) & 0x7f #shift 7 and take next 7 bits for msb
-        cmd = chr(0x07) + chr(chan) + chr(lsb) + chr(msb)
-        self.sendCmd(cmd)
+        self.sendValueCmd(SET_SPEED, chan, speed)
 
     # Set acceleration of channel
     # This provide soft starts and finishes when servo moves to target position.
     # Valid values are from 0 to 255. 0=unrestricted, 1 is slowest start.
     # A value of 1 will take the servo about 3s to move between 1ms to 2ms range.
     def setAccel(self, chan, accel):
-        lsb = accel & 0x7f #7 bits for least significant byte
-        msb = (accel >> 7) & 0x7f #shift 7 and take next 7 bits for msb
-        cmd = chr(0x09) + chr(chan) + chr(lsb) + chr(msb)
-        self.sendCmd(cmd)
+        self.sendValueCmd(SET_ACCEL, chan, accel)
     
     # Get the current position of the device on the specified channel
     # The result is returned in a measure of quarter-microseconds, which mirrors
@@ -123,11 +308,30 @@ class Controller:
     # the position result will align well with the acutal servo position, assuming
     # it is not stalled or slowed.
     def getPosition(self, chan):
-        cmd = chr(0x10) + chr(chan)
-        self.sendCmd(cmd)
-        lsb = ord(self.usb.read())
-        msb = ord(self.usb.read())
-        return (msb << 8) + lsb
+        with self.lock:
+            self.sendCmd(bytearray((GET_POSITION, chan)))
+            data = bytearray(self.usb.read(2))
+        return (data[1] << 8) + data[0]
+
+    # Get the current positions of several channels with one write and one read.
+    # The Get Position commands are sent back to back and the replies, two bytes
+    # per channel, come back in the same order.  Returns a {chan: position} dict.
+    def getPositions(self, chans):
+        positions = {}
+        if not chans:
+            return positions
+        with self.lock:
+            n = 0
+            for chan in chans:
+                n = self.packHeader(n)
+                self.txBuf[n] = GET_POSITION
+                self.txBuf[n + 1] = chan
+                n += 2
+            self.usb.write(self.txView[:n])
+            data = bytearray(self.usb.read(2 * len(chans)))
+        for i, chan in enumerate(chans):
+            positions[chan] = (data[2 * i + 1] << 8) + data[2 * i]
+        return positions
 
     # Test to see if a servo has reached the set target position.  This only provides
     # useful results if the Speed parameter is set slower than the maximum speed of
@@ -136,9 +340,15 @@ class Controller:
     # ***Note if target position goes outside of Maestro's allowable range for the
     # channel, then the target can never be reached, so it will appear to always be
     # moving to the target.  
+    # If a StateMirror is attached the cached position is used, so this only costs
+    # a USB round trip when the cache is stale.
     def isMoving(self, chan):
         if self.Targets[chan] > 0:
-            if self.getPosition(chan) != self.Targets[chan]:
+            if self.mirror is not None:
+                position = self.mirror.getPosition(chan)
+            else:
+                position = self.getPosition(chan)
+            if position != self.Targets[chan]:
                 return True
         return False
     
@@ -146,9 +356,10 @@ class Controller:
     # Acceleration have been set on one or more of the channels. Returns True or False.
     # Not available with Micro Maestro.
     def getMovingState(self):
-        cmd = chr(0x13)
-        self.sendCmd(cmd)
-        if self.usb.read() == chr(0):
+        with self.lock:
+            self.sendCmd(bytearray((GET_MOVING_STATE,)))
+            data = bytearray(self.usb.read())
+        if data[0] == 0:
             return False
         else:
             return True
@@ -157,13 +368,294 @@ class Controller:
     # have multiple subroutines, which get numbered sequentially from 0 on up. Code your
     # Maestro subroutine to either infinitely loop, or just end (return is not valid).
     def runScriptSub(self, subNumber):
-        cmd = chr(0x27) + chr(subNumber)
         # can pass a param with command 0x28
-        # cmd = chr(0x28) + chr(subNumber) + chr(lsb) + chr(msb)
-        self.sendCmd(cmd)
+        # cmd = bytearray((0x28, subNumber, lsb, msb))
+        self.sendCmd(bytearray((RESTART_SCRIPT, subNumber)))
 
     # Stop the current Maestro Script
     def stopScript(self):
-        cmd = chr(0x24)
-        self.sendCmd(cmd)
+        self.sendCmd(bytearray((STOP_SCRIPT,)))
+
 
+# Last known state of one servo channel
+class ServoState:
+    def __init__(self, position=0, target=0, timestamp=0.0):
+        self.position = position
+        self.target = target
+        # time.monotonic() when the position was read
+        self.timestamp = timestamp
+
+    def isMoving(self):
+        return self.target > 0 and self.position != self.target
+
+
+#
+# Keeps a cached copy of the servo positions so telemetry and isMoving checks
+# don't each cost a USB round trip.  Positions are read for all mirrored
+# channels at once with getPositions, either on demand once the cache is older
+# than staleness seconds, or from a background poller started with start().
+#
+class StateMirror:
+    def __init__(self, controller, chans, staleness=0.05):
+        self.controller = controller
+        self.chans = list(chans)
+        self.staleness = staleness
+        self.States = dict((chan, ServoState()) for chan in self.chans)
+        self.refreshes = 0
+        self.pollThread = None
+        self.stopPolling = threading.Event()
+        controller.mirror = self
+
+    # Read all mirrored channels in one round trip
+    def refresh(self):
+        positions = self.controller.getPositions(self.chans)
+        now = time.monotonic()
+        for chan in self.chans:
+            state = self.States[chan]
+            state.position = positions[chan]
+            state.target = self.controller.Targets[chan]
+            state.timestamp = now
+        self.refreshes += 1
+
+    # Is the cached state older than the staleness window?
+    def isStale(self, chan):
+        return time.monotonic() - self.States[chan].timestamp > self.staleness
+
+    # State of a channel, refreshed first if it is stale
+    def getState(self, chan):
+        if chan not in self.States:
+            # not mirrored, read it directly
+            return ServoState(self.controller.getPosition(chan),
+                              self.controller.Targets[chan], time.monotonic())
+        if self.isStale(chan):
+            self.refresh()
+        state = self.States[chan]
+        state.target = self.controller.Targets[chan]
+        return state
+
+    def getPosition(self, chan):
+        return self.getState(chan).position
+
+    def isMoving(self, chan):
+        return self.getState(chan).isMoving()
+
+    # Poll the positions from a background thread every interval seconds.  With
+    # a staleness longer than the interval readers never wait on the USB link.
+    def start(self, interval=0.02):
+        if self.pollThread is not None:
+            return
+        self.stopPolling.clear()
+        self.pollThread = threading.Thread(target=self.poll, args=(interval,))
+        self.pollThread.daemon = True
+        self.pollThread.start()
+
+    def poll(self, interval):
+        self.refresh()
+        while not self.stopPolling.wait(interval):
+            self.refresh()
+
+    def stop(self):
+        self.stopPolling.set()
+        if self.pollThread is not None:
+            self.pollThread.join()
+            self.pollThread = None
+
+
+#
+#---------------------------
+# Shared ports and the device registry
+#---------------------------
+#
+# Several subsystems (drive, head, arm) can share one Maestro link, and
+# several Maestros can share one serial port when they are daisy chained,
+# each answering to its own Pololu device number.  A SharedPort owns the
+# serial handle for a port and is handed to every Controller on it as usb.
+# Writes go into a per-port queue and are sent by that port's writer thread,
+# so a slow link only holds up commands for its own port.
+#
+class SharedPort:
+    def __init__(self, ttyStr='/dev/ttyACM0', usb=None):
+        if usb is None:
+            usb = serial.Serial(ttyStr)
+        self.ttyStr = ttyStr
+        self.usb = usb
+        # Used as the lock of every Controller on this port, see Controller.__init__
+        self.portLock = threading.RLock()
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.users = 0
+        self.writes = 0
+        self.bytesWritten = 0
+        self.writer = threading.Thread(target=self.writeLoop, name='maestro ' + ttyStr)
+        self.writer.daemon = True
+        self.writer.start()
+
+    # Queue bytes to send and return right away.  The data is copied, so the
+    # caller can reuse its buffer.
+    def write(self, data):
+        with self.cond:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            if self.closed:
+                raise IOError('port %s is closed' % self.ttyStr)
+            self.queue.append(bytes(data))
+            self.cond.notify_all()
+        return len(data)
+
+    # Send everything queued, whatever piled up while the last write was
+    # going out is joined into one write.
+    def writeLoop(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                data = b''.join(self.queue)
+                self.queue.clear()
+                self.busy = True
+            try:
+                self.usb.write(data)
+                self.writes += 1
+                self.bytesWritten += len(data)
+            except Exception as e:
+                # raised to the next caller of write or flush
+                self.error = e
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    # Wait until everything queued has been written
+    def flush(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.queue and not self.busy)
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+
+    # Replies come after the commands that asked for them, so send those first
+    def read(self, size=1):
+        self.flush()
+        return self.usb.read(size)
+
+    # Controllers close the port when they are done with it, the serial
+    # handle is closed when the last one does
+    def close(self):
+        with self.cond:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        self.usb.close()
+
+
+# Channel numbers of the robot's servos by name, one Maestro on /dev/ttyACM0
+ROBOT_CHANNELS = {
+    'body': 0,
+    'motors': 1,
+    'turn': 2,
+    'headTurn': 3,
+    'headTilt': 4,
+    'shoulder': 6,
+    'shoulderSide': 7,
+    'elbow': 8,
+    'hand': 11,
+}
+
+
+#
+# Named Maestros and named channels on them.  Each port is opened once and
+# shared by every device on it, so scripts that ask for the same device get
+# the same Controller.  Channels are addressed by name, and a setTargets that
+# spans devices sends one command per device.
+#
+#   registry = Registry()
+#   registry.addDevice('drive', '/dev/ttyACM0', 0x0c, {'motors': 1, 'turn': 2})
+#   registry.addDevice('arm', '/dev/ttyACM0', 0x0d, {'elbow': 0, 'hand': 1})
+#   registry.setTargets({'motors': 6200, 'hand': 5000})
+#
+class Registry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.Ports = {}
+        self.Devices = {}
+        self.DeviceKeys = {}
+        # name -> (device name, channel)
+        self.Channels = {}
+
+    # Shared port for a tty, opened the first time.  An already open port, or
+    # anything with the same write/read methods, can be passed as usb.
+    def openPort(self, ttyStr='/dev/ttyACM0', usb=None):
+        with self.lock:
+            port = self.Ports.get(ttyStr)
+            if port is None or port.closed:
+                port = self.Ports[ttyStr] = SharedPort(ttyStr, usb)
+            return port
+
+    # Add a Maestro, chained devices on one port each get their own name and
+    # device number.  Asking again for the same port and device number returns
+    # the Controller already made.  channels is a {name: channel} map.
+    def addDevice(self, name, ttyStr='/dev/ttyACM0', device=0x0c, channels=None, usb=None):
+        with self.lock:
+            key = (ttyStr, device)
+            if key in self.DeviceKeys:
+                controller = self.Devices[self.DeviceKeys[key]]
+            else:
+                if name in self.Devices:
+                    raise ValueError('device name %s is already used' % name)
+                port = self.openPort(ttyStr, usb)
+                controller = Controller(ttyStr, device, usb=port)
+                port.users += 1
+                self.Devices[name] = controller
+                self.DeviceKeys[key] = name
+            if channels:
+                self.mapChannels(self.DeviceKeys[key], channels)
+            return controller
+
+    def getDevice(self, name):
+        return self.Devices[name]
+
+    # Name the channels of a device, {name: channel}
+    def mapChannels(self, device, channels):
+        with self.lock:
+            if device not in self.Devices:
+                raise KeyError('no device named %s' % device)
+            for name, chan in channels.items():
+                self.Channels[name] = (device, chan)
+
+    # Controller and channel number of a named channel
+    def channel(self, name):
+        device, chan = self.Channels[name]
+        return self.Devices[device], chan
+
+    def setTarget(self, name, target):
+        controller, chan = self.channel(name)
+        controller.setTarget(chan, target)
+
+    # Set named channels from a {name: target} dict, one setTargets per device
+    def setTargets(self, targets):
+        byDevice = {}
+        for name, target in targets.items():
+            device, chan = self.Channels[name]
+            byDevice.setdefault(device, {})[chan] = target
+        for device, chanTargets in byDevice.items():
+            self.Devices[device].setTargets(chanTargets)
+
+    def getPosition(self, name):
+        controller, chan = self.channel(name)
+        return controller.getPosition(chan)
+
+    def close(self):
+        with self.lock:
+            for controller in self.Devices.values():
+                controller.close()
+            self.Devices.clear()
+            self.DeviceKeys.clear()
+            self.Channels.clear()
+            self.Ports.clear()
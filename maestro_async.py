@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import os
+import maestro
+
+
+class _TransportWriter:
+    """
+    Gives an asyncio writer the write method of a serial port, so maestro.Controller can
+    pack commands straight into the transport's buffer
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        # the transport may keep a reference, so copy out of the controller's reused buffer
+        self.writer.write(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        raise RuntimeError("replies are read by AsyncController, not by the wrapped Controller")
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncController:
+    """
+    asyncio version of maestro.Controller
+
+    Writes go straight to a non-blocking transport. Every command that expects a reply queues
+    a future for its reply bytes in the same step as its write, and one reader task hands out
+    the bytes in the order they arrive. Concurrent queries therefore can't mix up their replies.
+
+    Clamping, Targets bookkeeping and command encoding are shared with maestro.Controller.
+    The timed flush of enableBuffer uses a thread and should not be used here, a window of 0 is fine
+    """
+
+    def __init__(self, reader, writer, device=0x0c):
+        """
+        Has to be created inside a running event loop, it starts the reply reader task
+        :param reader: asyncio.StreamReader or anything with an awaitable readexactly(n)
+        :param writer: asyncio.StreamWriter or anything with write(data) and an awaitable drain()
+        :param device: Pololu device number
+        """
+        self.reader = reader
+        self.writer = writer
+        self.controller = maestro.Controller(device=device, usb=_TransportWriter(writer))
+        self.header = self.controller.PololuCmd
+        self.replies = collections.deque()
+        self.reply_ready = asyncio.Event()
+        self.read_task = asyncio.ensure_future(self._read_replies())
+
+    @classmethod
+    async def open(cls, tty_str='/dev/ttyACM0', device=0x0c):
+        """
+        Opens a serial device, or the pty of a fake one, in non-blocking raw mode
+        :param tty_str: path of the device
+        :param device: Pololu device number
+        :return: connected AsyncController
+        """
+        import tty
+        loop = asyncio.get_running_loop()
+        fd = os.open(tty_str, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(fd)
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                     os.fdopen(fd, 'rb', buffering=0))
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, os.fdopen(os.dup(fd), 'wb', buffering=0))
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        return cls(reader, writer, device)
+
+    @property
+    def Targets(self):
+        return self.controller.Targets
+
+    def set_range(self, chan, min, max):
+        self.controller.setRange(chan, min, max)
+
+    async def close(self):
+        self.read_task.cancel()
+        while self.replies:
+            _, future = self.replies.popleft()
+            if not future.done():
+                future.cancel()
+        self.writer.close()
+
+    async def _read_replies(self):
+        while True:
+            while not self.replies:
+                self.reply_ready.clear()
+                await self.reply_ready.wait()
+            size, future = self.replies[0]
+            data = await self.reader.readexactly(size)
+            self.replies.popleft()
+            # the bytes are read even if the caller gave up, so the next reply stays aligned
+            if not future.done():
+                future.set_result(data)
+
+    async def _request(self, packet, size):
+        """
+        Writes a packet and waits for its reply
+        :param packet: bytes to write
+        :param size: number of reply bytes
+        :return: the reply bytes
+        """
+        future = asyncio.get_running_loop().create_future()
+        # no await between queueing the reply and writing, so the order can't change
+        self.replies.append((size, future))
+        self.reply_ready.set()
+        self.writer.write(packet)
+        await self.writer.drain()
+        return await future
+
+    async def set_target(self, chan, target):
+        self.controller.setTarget(chan, target)
+        await self.writer.drain()
+
+    async def set_targets(self, targets):
+        """
+        :param targets: {chan: target, ...} dict, see maestro.Controller.setTargets
+        """
+        self.controller.setTargets(targets)
+        await self.writer.drain()
+
+    async def set_speed(self, chan, speed):
+        self.controller.setSpeed(chan, speed)
+        await self.writer.drain()
+
+    async def set_accel(self, chan, accel):
+        self.controller.setAccel(chan, accel)
+        await self.writer.drain()
+
+    async def get_position(self, chan):
+        data = await self._request(self.header + bytes((maestro.GET_POSITION, chan)), 2)
+        return (data[1] << 8) + data[0]
+
+    async def get_positions(self, chans):
+        """
+        Reads several channels with one write and one reply
+        :param chans: list of channels
+        :return: {chan: position} dict
+        """
+        packet = b''.join(self.header + bytes((maestro.GET_POSITION, chan)) for chan in chans)
+        data = await self._request(packet, 2 * len(chans))
+        return dict((chan, (data[2 * i + 1] << 8) + data[2 * i]) for i, chan in enumerate(chans))
+
+    async def get_moving_state(self):
+        data = await self._request(self.header + bytes((maestro.GET_MOVING_STATE,)), 1)
+        return data[0] != 0
+
+    async def is_moving(self, chan):
+        if self.Targets[chan] > 0:
+            return await self.get_position(chan) != self.Targets[chan]
+        return False
@@ -0,0 +1,209 @@
+import threading
+import time
+import maestro
+
+#
+#---------------------------
+# Simulated Maestro
+#---------------------------
+#
+# Stands in for the serial port of a Maestro so Controller, and everything
+# built on it, can run without hardware.  Commands are parsed in both the
+# Pololu protocol (0xAA, device number, command) and the compact protocol
+# (command byte with the high bit set), and servo positions ramp toward their
+# targets using the channel's speed and acceleration like the real device.
+#
+#   tango = maestro.Controller(usb=SimulatedMaestro())
+#
+
+# data bytes that follow each command byte, Set Multiple Targets is variable
+DATA_LENGTHS = {
+    maestro.SET_TARGET: 3,
+    maestro.SET_SPEED: 3,
+    maestro.SET_ACCEL: 3,
+    maestro.GET_POSITION: 1,
+    maestro.GET_MOVING_STATE: 0,
+    maestro.STOP_SCRIPT: 0,
+    maestro.RESTART_SCRIPT: 1,
+}
+
+# the Maestro updates its servo pulses in steps of this many seconds
+UPDATE_PERIOD = 0.01
+
+
+class SimulatedMaestro:
+    """
+    Serial port look-alike that behaves like a Maestro
+    Speed is in 0.25us per 10ms and acceleration in 0.25us per 10ms per 80ms, as on the device
+    """
+
+    def __init__(self, device=0x0c, channels=24, clock=time.monotonic):
+        """
+        :param device: device number this Maestro answers to in the Pololu protocol
+        :param channels: number of servo channels
+        :param clock: function returning the current time in seconds
+        """
+        self.device = device
+        self.clock = clock
+        self.positions = [0.0] * channels
+        self.velocities = [0.0] * channels
+        self.targets = [0] * channels
+        self.speeds = [0] * channels
+        self.accels = [0] * channels
+        self.script_running = False
+        self.script_sub = None
+        self.last_update = clock()
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.lock = threading.Lock()
+        # counts of what the host sent
+        self.bytes_received = 0
+        self.writes = 0
+        self.commands = {}
+
+    @property
+    def command_count(self):
+        return sum(self.commands.values())
+
+    @property
+    def in_waiting(self):
+        return len(self.tx)
+
+    def write(self, data):
+        with self.lock:
+            self.update()
+            self.rx += data
+            self.bytes_received += len(data)
+            self.writes += 1
+            self._parse()
+        return len(data)
+
+    def read(self, size=1):
+        with self.lock:
+            data = bytes(self.tx[:size])
+            del self.tx[:size]
+        return data
+
+    def close(self):
+        pass
+
+    def reset_counters(self):
+        with self.lock:
+            self.bytes_received = 0
+            self.writes = 0
+            self.commands = {}
+
+    def _parse(self):
+        rx = self.rx
+        while rx:
+            if rx[0] == 0xaa:
+                # Pololu protocol
+                if len(rx) < 3:
+                    return
+                device, cmd, start = rx[1], rx[2], 3
+            elif rx[0] & 0x80:
+                # compact protocol
+                device, cmd, start = self.device, rx[0] & 0x7f, 1
+            else:
+                # not a command byte, skip it like the device does
+                del rx[0]
+                continue
+            if cmd == maestro.SET_MULTIPLE_TARGETS:
+                if len(rx) < start + 1:
+                    return
+                length = 2 + 2 * rx[start]
+            elif cmd in DATA_LENGTHS:
+                length = DATA_LENGTHS[cmd]
+            else:
+                # unknown command, drop the lead-in and resync
+                del rx[0]
+                continue
+            if len(rx) < start + length:
+                return
+            data = rx[start:start + length]
+            del rx[:start + length]
+            if device == self.device:
+                self._run(cmd, data)
+
+    def _run(self, cmd, data):
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        if cmd == maestro.SET_TARGET:
+            self._set_target(data[0], data[1] + (data[2] << 7))
+        elif cmd == maestro.SET_MULTIPLE_TARGETS:
+            for i in range(data[0]):
+                self._set_target(data[1] + i, data[2 + 2 * i] + (data[3 + 2 * i] << 7))
+        elif cmd == maestro.SET_SPEED:
+            self.speeds[data[0]] = data[1] + (data[2] << 7)
+        elif cmd == maestro.SET_ACCEL:
+            self.accels[data[0]] = data[1] + (data[2] << 7)
+        elif cmd == maestro.GET_POSITION:
+            position = int(round(self.positions[data[0]]))
+            self.tx += bytes((position & 0xff, (position >> 8) & 0xff))
+        elif cmd == maestro.GET_MOVING_STATE:
+            self.tx.append(1 if self.is_moving() else 0)
+        elif cmd == maestro.STOP_SCRIPT:
+            self.script_running = False
+        elif cmd == maestro.RESTART_SCRIPT:
+            self.script_running = True
+            self.script_sub = data[0]
+
+    def _set_target(self, chan, target):
+        self.targets[chan] = target
+        if target == 0 or self.positions[chan] == 0:
+            # a channel that is off jumps straight to its first target
+            self.positions[chan] = float(target)
+            self.velocities[chan] = 0.0
+
+    def is_moving(self):
+        self.update()
+        return any(self.positions[chan] != self.targets[chan] for chan in range(len(self.targets)))
+
+    def update(self):
+        """
+        Moves every servo toward its target for the time passed since the last update
+        :return:
+        """
+        now = self.clock()
+        steps = int((now - self.last_update) / UPDATE_PERIOD)
+        if steps <= 0:
+            return
+        self.last_update += steps * UPDATE_PERIOD
+        for chan in range(len(self.targets)):
+            for _ in range(steps):
+                if not self._step(chan):
+                    break
+
+    def _step(self, chan):
+        """
+        Moves one servo for one update period
+        :param chan: channel to move
+        :return: True if the servo is still moving
+        """
+        position, target = self.positions[chan], self.targets[chan]
+        distance = target - position
+        if distance == 0:
+            self.velocities[chan] = 0.0
+            return False
+        speed, accel = self.speeds[chan], self.accels[chan]
+        if speed == 0 and accel == 0:
+            self.positions[chan] = float(target)
+            self.velocities[chan] = 0.0
+            return False
+        velocity = abs(self.velocities[chan])
+        if accel > 0:
+            # velocity grows by accel every 80ms and slows down in time to stop on the target
+            velocity += accel / 8.0
+            velocity = min(velocity, (2 * accel / 8.0 * abs(distance)) ** 0.5)
+        else:
+            velocity = speed
+        if speed > 0:
+            velocity = min(velocity, speed)
+        velocity = max(velocity, 1.0)
+        if velocity >= abs(distance):
+            self.positions[chan] = float(target)
+            self.velocities[chan] = 0.0
+            return False
+        direction = 1 if distance > 0 else -1
+        self.positions[chan] = position + direction * velocity
+        self.velocities[chan] = direction * velocity
+        return True
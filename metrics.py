@@ -0,0 +1,301 @@
+import contextlib
+import http.server
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+class LatencyHistogram:
+    """
+    The last size samples of a latency in a preallocated ring, adding one is a single array store.
+    Percentiles are worked out only when a summary is asked for
+    """
+
+    def __init__(self, size=1024):
+        """
+        :param size: number of samples kept
+        """
+        self.samples = np.zeros(size)
+        self.size = size
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples[self.count % self.size] = seconds
+        self.count += 1
+
+    def summary(self):
+        """
+        :return: dict of the sample count and the p50, p95, p99, mean and max of the kept samples in ms
+        """
+        kept = self.samples[:min(self.count, self.size)]
+        if not len(kept):
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(kept, (50, 95, 99)) * 1000
+        return {"count": self.count, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+                "mean_ms": kept.mean() * 1000, "max_ms": kept.max() * 1000}
+
+
+class Metrics:
+    """
+    Latencies and counters of the control loop, cheap enough to leave on
+
+    Latencies go into a LatencyHistogram per name. Counters are running totals, either counted
+    with count or read from a function with watch, such as the byte count of a serial port.
+    snapshot reports each counter's rate over the last whole second. Levels, such as a threshold
+    that moves up and down, are read with watch too but are reported as they are, without a rate
+    """
+
+    def __init__(self, size=1024, clock=time.monotonic):
+        """
+        :param size: samples kept per latency
+        :param clock: function returning the current time in seconds
+        """
+        self.size = size
+        self.clock = clock
+        self.histograms = {}
+        self.totals = {}
+        self.sources = {}
+        # watched names that are levels, not counters
+        self.levels = set()
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.window_start = self.started
+        self.window_totals = {}
+        self.rates = {}
+
+    def observe(self, name, seconds):
+        """
+        :param name: what was timed
+        :param seconds: how long it took
+        :return:
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, LatencyHistogram(self.size))
+        histogram.add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Times the body of a with block
+        :param name: what the block does
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter_ns() - start) * 1e-9)
+
+    def count(self, name, n=1):
+        """
+        Adds to a counter, each counter should only be counted from one thread
+        :param name: what is counted
+        :param n: amount to add
+        :return:
+        """
+        self.totals[name] = self.totals.get(name, 0) + n
+
+    def watch(self, name, read, rate=True):
+        """
+        Reports a total that is kept somewhere else as a counter, it is only read for snapshots
+        :param name: what is counted
+        :param read: function returning the current total
+        :param rate: report the rate per second, False for a level that is only reported as it is
+        :return:
+        """
+        self.sources[name] = read
+        if rate:
+            self.levels.discard(name)
+        else:
+            self.levels.add(name)
+
+    def instrument_port(self, controller, name="serial"):
+        """
+        Times every write to a maestro.Controller's port and counts the bytes written. On a
+        maestro.SharedPort the controller's write only queues the data, so the writes of the
+        port's writer thread to the serial port are timed instead
+        :param controller: maestro.Controller
+        :param name: prefix of the latency and counter names
+        :return: the TimedPort now used by the controller or its shared port
+        """
+        owner = controller.usb if hasattr(controller.usb, "writeLoop") else controller
+        with controller.lock:
+            if isinstance(owner.usb, TimedPort):
+                # another controller on the same shared port is already timed
+                port = owner.usb
+            else:
+                port = TimedPort(owner.usb, self, name)
+                owner.usb = port
+        self.watch(name + "_bytes", lambda: port.bytes)
+        self.watch(name + "_writes", lambda: port.writes)
+        return port
+
+    def _totals(self):
+        totals = dict(self.totals)
+        for name, read in self.sources.items():
+            totals[name] = read()
+        return totals
+
+    def snapshot(self):
+        """
+        :return: dict of the uptime, each counter's total and rate per second, and each latency's summary
+        """
+        with self.lock:
+            now = self.clock()
+            totals = self._totals()
+            elapsed = now - self.window_start
+            if elapsed >= 1.0:
+                # rates cover the last whole window, however often snapshots are taken
+                self.rates = dict((name, (total - self.window_totals.get(name, 0)) / elapsed)
+                                  for name, total in totals.items() if name not in self.levels)
+                self.window_totals = totals
+                self.window_start = now
+            return {
+                "uptime": now - self.started,
+                "totals": totals,
+                "per_second": dict(self.rates),
+                "latency": dict((name, h.summary()) for name, h in list(self.histograms.items())),
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def log_line(self):
+        """
+        :return: one line with the rates, the levels and the p50/p95/p99 of each latency
+        """
+        snap = self.snapshot()
+        parts = ["%s %.1f/s" % (name, rate) for name, rate in sorted(snap["per_second"].items())]
+        parts += ["%s %g" % (name, snap["totals"][name]) for name in sorted(self.levels)]
+        for name, s in sorted(snap["latency"].items()):
+            if s["count"]:
+                parts.append("%s %.2f/%.2f/%.2f ms" % (name, s["p50_ms"], s["p95_ms"], s["p99_ms"]))
+        return " | ".join(parts)
+
+
+class TimedPort:
+    """
+    Wraps a serial port, timing each write and counting the bytes
+    """
+
+    def __init__(self, usb, metrics, name="serial"):
+        self.usb = usb
+        self.metrics = metrics
+        self.name = name + "_write"
+        self.bytes = 0
+        self.writes = 0
+
+    def write(self, data):
+        start = time.perf_counter_ns()
+        n = self.usb.write(data)
+        self.metrics.observe(self.name, (time.perf_counter_ns() - start) * 1e-9)
+        self.bytes += len(data)
+        self.writes += 1
+        return n
+
+    def __getattr__(self, name):
+        # read, in_waiting, close and the rest go straight to the port
+        return getattr(self.usb, name)
+
+
+class MetricsReporter:
+    """
+    Exports a snapshot every interval seconds from its own thread, as a log line or a JSON file
+    """
+
+    def __init__(self, metrics, interval=1.0, log=print, path=None):
+        """
+        :param metrics: Metrics to export
+        :param interval: seconds between exports
+        :param log: function called with a log line, None to skip the log line
+        :param path: JSON file to rewrite with each snapshot, None to skip it
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.log = log
+        self.path = path
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._report, name="metrics", daemon=True)
+        self.thread.start()
+
+    def _report(self):
+        while not self.stopping.wait(self.interval):
+            self.export()
+
+    def export(self):
+        if self.log is not None:
+            self.log(self.metrics.log_line())
+        if self.path is not None:
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                f.write(self.metrics.to_json())
+            # renamed into place so a reader never sees half a file
+            os.replace(temp, self.path)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        # the last partial interval is exported too
+        self.export()
+
+
+class MetricsServer:
+    """
+    Serves the snapshot as JSON over HTTP, GET http://host:port/metrics
+    """
+
+    def __init__(self, metrics, port=8091, host="127.0.0.1"):
+        """
+        :param metrics: Metrics to serve
+        :param port: port to listen on
+        :param host: address to listen on, the default only accepts local connections
+        """
+        self.metrics = metrics
+        self.server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+        self.thread.start()
+
+    def _handler(self):
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.to_json().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def open_exporter(metrics, spec):
+    """
+    Starts exporting metrics from a short description
+    :param metrics: Metrics to export
+    :param spec: "log:SECONDS", "json:FILE" (rewritten every second) or "http:PORT"
+    :return: MetricsReporter or MetricsServer, close it when done
+    """
+    kind, _, where = spec.partition(":")
+    if kind == "log":
+        return MetricsReporter(metrics, float(where or 1.0))
+    if kind == "json":
+        return MetricsReporter(metrics, 1.0, log=None, path=where or "metrics.json")
+    if kind == "http":
+        return MetricsServer(metrics, int(where or 8091))
+    raise ValueError("unknown metrics output %r, use log:SECONDS, json:FILE or http:PORT" % spec)
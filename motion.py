@@ -0,0 +1,203 @@
+import math
+import threading
+import time
+
+
+class MotionScheduler:
+    """
+    Plays a motion profile one step per tick instead of sleeping between steps,
+    so the caller is never blocked while a maneuver plays out.
+    A newer profile replaces the steps that have not run yet
+    """
+
+    def __init__(self, apply_step, period=0.1, clock=time.monotonic):
+        """
+        :param apply_step: function called with each step of a profile
+        :param period: minimum seconds between two steps
+        :param clock: function returning the current time in seconds
+        """
+        self.apply_step = apply_step
+        self.period = period
+        self.clock = clock
+        self.steps = []
+        self.next_due = 0.0
+        self.preempted = 0
+        self._lock = threading.Lock()
+
+    @property
+    def idle(self):
+        return not self.steps
+
+    def submit(self, profile):
+        """
+        Replaces the rest of the current profile with a new one
+        :param profile: list of steps to play in order
+        :return:
+        """
+        with self._lock:
+            if self.steps:
+                self.preempted += 1
+            self.steps = list(profile)
+
+    def tick(self, now=None):
+        """
+        Runs the next step if one is waiting and the last step was at least one period ago
+        :param now: current time, read from the clock if not given
+        :return: True if a step was run
+        """
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            if not self.steps or now < self.next_due:
+                return False
+            step = self.steps.pop(0)
+            self.next_due = now + self.period
+        self.apply_step(step)
+        return True
+
+    def clear(self):
+        """
+        Drops every step that has not run yet
+        :return:
+        """
+        with self._lock:
+            self.steps = []
+
+
+# The Maestro counts speed in target units (0.25 us) per 10 ms and acceleration
+# in target units per 10 ms per 80 ms, both registers are 0 for unlimited
+SPEED_PER_UNIT_PER_SECOND = 0.01
+ACCEL_PER_UNIT_PER_SECOND2 = 0.01 * 0.08
+MAX_SPEED = 0x3fff
+MAX_ACCEL = 255
+
+
+class TrajectoryPlanner:
+    """
+    Moves joints to a goal with one target command each and lets the Maestro ramp them, instead
+    of the host sending many small steps. The speed and acceleration registers are worked out
+    from the duration or velocity of the move, and only sent when they change.
+    Positions are in target units, a quarter microsecond
+    """
+
+    def __init__(self, controller, accel_time=0.2):
+        """
+        :param controller: maestro.Controller the joints are on
+        :param accel_time: seconds spent speeding up at the start of a move and slowing down at the end
+        """
+        self.controller = controller
+        self.accel_time = accel_time
+        # registers last sent to each channel
+        self.speeds = {}
+        self.accels = {}
+        self.moves = 0
+
+    def registers(self, distance, duration=None, velocity=None):
+        """
+        Works out the registers of a trapezoid move, accelerating for accel_time, cruising and
+        slowing down for accel_time
+        :param distance: how far the joint moves, in target units
+        :param duration: seconds the move should take
+        :param velocity: cruise speed in target units per second, used if there is no duration
+        :return: (speed, accel) registers, 0 is unlimited
+        """
+        distance = abs(distance)
+        if duration is not None:
+            if duration <= 0 or distance == 0:
+                return 0, 0
+            # a short move spends at most half its time on each ramp
+            ramp = min(self.accel_time, duration / 2.0)
+            velocity = distance / (duration - ramp)
+        elif velocity is None:
+            return 0, 0
+        else:
+            ramp = self.accel_time
+        speed = min(MAX_SPEED, max(1, int(math.ceil(velocity * SPEED_PER_UNIT_PER_SECOND))))
+        if ramp <= 0:
+            return speed, 0
+        accel = velocity / ramp
+        accel = min(MAX_ACCEL, max(1, int(math.ceil(accel * ACCEL_PER_UNIT_PER_SECOND2))))
+        return speed, accel
+
+    def start_position(self, chan):
+        # the last target is where the joint is or is heading, reading it costs a round trip
+        target = self.controller.Targets[chan]
+        return target if target > 0 else self.controller.getPosition(chan)
+
+    def move(self, goals, duration=None, velocity=None):
+        """
+        Starts moving joints to their goals. With a duration every joint gets its own speed so
+        they all arrive together
+        :param goals: {chan: target} dict
+        :param duration: seconds the move should take
+        :param velocity: cruise speed in target units per second, used if there is no duration
+        :return: {chan: (speed, accel)} registers used
+        """
+        used = {}
+        for chan, goal in goals.items():
+            speed, accel = self.registers(goal - self.start_position(chan), duration, velocity)
+            if self.speeds.get(chan) != speed:
+                self.controller.setSpeed(chan, speed)
+                self.speeds[chan] = speed
+            if self.accels.get(chan) != accel:
+                self.controller.setAccel(chan, accel)
+                self.accels[chan] = accel
+            used[chan] = (speed, accel)
+        self.controller.setTargets(goals)
+        self.moves += 1
+        return used
+
+    def clear_limits(self, chans):
+        """
+        Sets the speed and acceleration of joints back to unlimited, so their next target is
+        reached at once instead of with the ramp of the last move
+        :param chans: channels to clear
+        :return:
+        """
+        for chan in chans:
+            if self.speeds.get(chan, 0) != 0:
+                self.controller.setSpeed(chan, 0)
+            if self.accels.get(chan, 0) != 0:
+                self.controller.setAccel(chan, 0)
+            self.speeds[chan] = 0
+            self.accels[chan] = 0
+
+    def jump(self, goals):
+        """
+        Sends joints straight to their goals with no ramp, for stops and going back to neutral
+        :param goals: {chan: target} dict
+        :return:
+        """
+        self.clear_limits(goals)
+        self.controller.setTargets(goals)
+
+    def stop(self, chans):
+        """
+        Stops joints where they are now
+        :param chans: channels to stop
+        :return: {chan: target} the joints were stopped at
+        """
+        positions = self.controller.getPositions(list(chans))
+        # with the limits of the move still set the joints would slow down past these positions
+        self.jump(positions)
+        return positions
+
+    def done(self):
+        """
+        :return: True once every servo on the Maestro has reached its target
+        """
+        return not self.controller.getMovingState()
+
+    def wait(self, timeout=None, poll=0.02):
+        """
+        Waits for the current moves to finish
+        :param timeout: most seconds to wait, None waits as long as it takes
+        :param poll: seconds between checks
+        :return: True if they finished, False if the wait timed out
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.done():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
@@ -1,11 +1,65 @@
+import maestro
+import resources
 import numpy as np
 import cv2 as cv
-import maestro
-import time
+from vision import find_centroid, path_box, detect_face, expand_box, AutoCanny, Preprocessor, RoiTracker, ScratchBuffers
+from pipeline import FramePipeline
+from motion import MotionScheduler, TrajectoryPlanner
+from steering import PidSteering
+
+
+class LazyController:
+    """
+    Mixin for the followers that drive the Maestro. The controller is only opened when the
+    first command is sent, so headless runs and tools that never move anything don't need one.
+    Set tango to use a controller of your own
+    """
+
+    _tango = None
+
+    @property
+    def tango(self):
+        """
+        Controller the commands go to, the default port is opened on first use
+        """
+        if self._tango is None:
+            self.tango = resources.controller(channels=maestro.ROBOT_CHANNELS)
+        return self._tango
+
+    @tango.setter
+    def tango(self, controller):
+        self._tango = controller
+        # clamped targets resend the same value every step, drop those writes
+        controller.enableBuffer()
+        self.setup_controller(controller)
+
+    def setup_controller(self, controller):
+        """
+        Sends the starting targets to a controller when it is set
+        :param controller: maestro.Controller
+        :return: None
+        """
+
+    def send_neutral(self, targets):
+        """
+        Sends stop targets at once
+        :param targets: {chan: target} dict
+        :return: None
+        """
+        self.tango.setTargets(targets)
 
-face_cascade = cv.CascadeClassifier('haarcascade_frontalface_default.xml')
+    def return_to_neutral(self, targets):
+        """
+        Sends stop targets with send_neutral if a controller was opened, when none was
+        nothing was sent, so nothing moved and there is nothing to open one for
+        :param targets: {chan: target} dict
+        :return: None
+        """
+        if self._tango is not None:
+            self.send_neutral(targets)
 
-class FaceFollow:
+
+class LineFollow(LazyController):
     """
     Assumptions:
     - images have index [0, 0] in the upper left
@@ -14,9 +68,13 @@ class FaceFollow:
     - y is the vertical axis and increase from top to bottom
     """
 
-    def __init__(self, image_name=None):
-        self.tango = maestro.Controller()
-        # zero all motors
+    def __init__(self, controller=None, window=True):
+        """
+        :param controller: maestro.Controller to send motor commands to, the default port is
+                           opened when the first command is sent if not given
+        :param window: show the frames in a window, it is created with the first frame,
+                       False runs headless and draws nothing
+        """
         self.body = 6000
         self.headTurn = 6000
         self.headTilt = 6000
@@ -26,18 +84,49 @@ class FaceFollow:
         self.TURN = 2
         self.end = False
         self.end_count = 0
-        self.tango.setTarget(4, 4000)
+        if controller is not None:
+            self.tango = controller
 
-        self.image_name = image_name
-        self.video_use = self.image_name is None
         # set video size variables to small, actual size is camera dependent
         self.frame_x = 200
         self.frame_y = 200
         self.frame_name = "Video"
-        cv.namedWindow(self.frame_name)
+        self.show_window = window
+        # sends some of the overlays elsewhere when set, see display.OverlayPublisher
+        self.publisher = None
         # some good starting values
         self.min_canny = 247
         self.max_canny = 255
+        # picks the thresholds from the frames when set, see enable_auto_canny
+        self.auto_canny = None
+        # limits the vision stages to a window around the path when set, see enable_tracking
+        self.tracker = None
+        self.window = None
+        # number of path pixels found by the last get_direction_vector
+        self.path_pixels = 0
+        # grayscale, downscale and blur settings of the preprocess stage
+        self.preprocessor = Preprocessor()
+        # stage outputs are written into these instead of new arrays every frame
+        self.scratch = ScratchBuffers()
+        # caches the stage results for the current frame
+        self.frame = None
+        self.pipeline = FramePipeline(self)
+        # plays motor bursts one step per tick, call scheduler.tick() often to keep them moving
+        self.scheduler = MotionScheduler(self.motor_step)
+        # steps in a burst of one action, the last one stops
+        self.burst = 8
+        # lets the Maestro ramp each burst from one target when set, see enable_trajectories
+        self.planner = None
+        # action of the glide playing now and the clock time its move ends, see glide
+        self.gliding = None
+        self.glide_end = 0.0
+        # logs the direction vector and some of the frames when set, see telemetry.TelemetryLog
+        self.telemetry = None
+        # sets the motor targets from the direction vector when set, see enable_pid
+        self.steering = None
+
+    def setup_controller(self, controller):
+        controller.setTarget(4, 4000)
 
     def pi_cam_loop(self, image):
         """
@@ -45,19 +134,88 @@ class FaceFollow:
         :param image: current frame to evaluate
         :return:
         """
+        self.process_frame(image)
+
+        # show frame, nothing is drawn when running headless
+        if self.show_window:
+            resources.window(self.frame_name)
+            cv.imshow(self.frame_name, self.pipeline.get("overlay"))
+        if self.publisher is not None and self.publisher.wants_frame():
+            self.publisher.publish(self.pipeline.get("overlay"))
+
+    def process_frame(self, image):
+        """
+        Sets the current frame, the pipeline stages run on it when their results are needed
+        :param image: current frame to evaluate
+        :return:
+        """
         self.frame = image
         self.frame_y, self.frame_x = self.frame.shape[:2]
-        ed = self.detect_line(self.frame)
-        # get the direction vector
-        vec = self.get_direction_vector(ed)
+        self.window = None
+        if self.tracker is not None:
+            scale = self.preprocessor.downscale
+            self.window = self.tracker.window((self.frame_y // scale, self.frame_x // scale))
+        self.pipeline.new_frame(self.frame)
+        if self.telemetry is not None:
+            self.telemetry.log_frame(self.pipeline.frame_count, image)
+
+    def enable_tracking(self, **kwargs):
+        """
+        Once the path is found, only process a window around it in the next frame,
+        see RoiTracker for the options
+        :return: the RoiTracker
+        """
+        self.tracker = RoiTracker(**kwargs)
+        return self.tracker
+
+    def place_in_frame(self, edges):
+        """
+        :param edges: edge image of the tracking window
+        :return: edge image the size of the whole frame with everything outside the window black
+        """
+        if self.window is None:
+            return edges
+        x, y, w, h = self.window
+        scale = self.preprocessor.downscale
+        full = self.scratch.get("frame_edges", (self.frame_y // scale, self.frame_x // scale))
+        full.fill(0)
+        full[y:y + h, x:x + w] = edges
+        return full
+
+    def locate_path(self, edges):
+        """
+        Finds the direction vector in the tracking window and moves the window for the next frame
+        :param edges: edge image of the whole frame from place_in_frame
+        :return: vector from get_direction_vector
+        """
+        vec = self.get_direction_vector(edges, roi=self.window)
+        if self.telemetry is not None:
+            self.telemetry.log_vector(self.pipeline.frame_count, vec[0], vec[1], self.path_pixels)
+        if self.tracker is not None:
+            self.tracker.update(self.path_pixels > 0, path_box(edges, self.window), edges.shape)
+        return vec
+
+    def draw_overlay(self, ed, vec):
+        """
+        Draws the COG vector on a copy of the edge image
+        :param ed: binary edge image, not changed
+        :param vec: direction vector from get_direction_vector
+        :return: edge image with the COG and the vector to it drawn on
+        """
+        ed = ed.copy()
+        # the edge image is smaller than the frame when the preprocessor downscales
+        ed_y, ed_x = ed.shape[:2]
+        scale = self.preprocessor.downscale
+        if self.window is not None:
+            # the tracking window
+            x, y, w, h = self.window
+            cv.rectangle(ed, (x, y), (x + w - 1, y + h - 1), 128)
         # location of the COG in as a box
-        rec_center = np.array((int(vec[0]) + self.frame_x // 2, int(vec[1]) + self.frame_y // 2))
+        rec_center = np.array((int(vec[0] / scale) + ed_x // 2, int(vec[1] / scale) + ed_y // 2))
         cv.rectangle(ed, tuple(rec_center - 4), tuple(rec_center + 4), 255)
         # draw line from origin to COG
-        cv.line(ed, (self.frame_x // 2, self.frame_y // 2), tuple(rec_center), 255)
-
-        # show frame
-        cv.imshow(self.frame_name, ed)
+        cv.line(ed, (ed_x // 2, ed_y // 2), tuple(rec_center), 255)
+        return ed
 
     def detect_line(self, image):
         """
@@ -65,59 +223,70 @@ class FaceFollow:
         :param image: image to reduce, non-destructive
         :return: reduced image
         """
+        return self.find_edges(self.preprocess(image))
+
+    def preprocess(self, image):
+        """
+        Prepares an image for edge detection, see Preprocessor
+        :param image: image to prepare, non-destructive
+        :return: prepared image, scaled down by preprocessor.downscale, only the tracking window
+                 of it when tracking
+        """
+        return self.preprocessor.apply(image, self.scratch, self.window)
 
-        edges = np.zeros(image.shape, np.uint8)
-        edges = cv.GaussianBlur(edges, (9, 9), cv.BORDER_DEFAULT)
-        # normalize image, this is for changing room lighting
-        cv.normalize(image, edges, 0, 255, cv.NORM_MINMAX)
+    def find_edges(self, image):
+        """
+        Reduces a preprocessed image to binary edge detection
+        :param image: image from preprocess, non-destructive
+        :return: reduced image
+        """
+        if self.auto_canny is not None:
+            self.min_canny, self.max_canny = self.auto_canny.update(image)
         # edge detection
-        edges = cv.Canny(edges, self.min_canny, self.max_canny)
-        edges = cv.dilate(edges, np.ones((2, 2)))
+        canny = self.scratch.get("canny", image.shape[:2])
+        cv.Canny(image, self.min_canny, self.max_canny, edges=canny)
+        edges = self.scratch.get("edges", image.shape[:2])
+        cv.dilate(canny, self.preprocessor.kernel, dst=edges)
         return edges
 
     def perform_movement(self):
         """
         Gets the motor commands needed for the current camera image
-        and tells the motors to move
+        and tells the motors to move, reusing the results of pi_cam_loop for the frame
         :return:
         """
-        # detect_line
-        line_image = self.detect_line(self.frame)
-        # get direction
-        x_v, y_v = self.get_direction_vector(line_image)
+        if self.pipeline.frame is not self.frame:
+            self.pipeline.new_frame(self.frame)
         # move
-        self.motor_control_from_dir(x_v, y_v)
+        self.perform_action(self.pipeline.get("command"))
 
-    def get_direction_vector(self, bin_img):
+    def get_direction_vector(self, bin_img, roi=None, stride=1):
         """
         Finds the vector from the center of the image to the Center of Gravity of the given
         Binary image, the COG is found by averaging the locations of all the white pixels in the image
         :param bin_img: a binary image of the path, where the following path is white and the background is black
-        :return: vector pointing in the direction of the COG from the center of the image
+        :param roi: optional (x, y, w, h) region of the image to search for the path
+        :param stride: only sample every stride-th row and column, 1 samples every pixel
+        :return: vector pointing in the direction of the COG from the center of the image,
+                 in frame pixels even when the edge image was downscaled by the preprocessor
         """
         # get image size
         img_h, img_w = bin_img.shape
 
-        # set up variables
-        avg_x, avg_y = 0, 0
-        number = 0
-        time.sleep(0.1)
-        for y in range(len(bin_img)):
-            for x in range(len(bin_img[0])):
-                # binary image so anything with a high value is taken as white
-                if bin_img[y][x] > 255/2:
-                    avg_x += x
-                    avg_y += y
-                    number += 1
+        avg_x, avg_y, number, _ = find_centroid(bin_img, roi, stride, self.scratch)
+        self.path_pixels = number
+        # the whole image counts for the off path check, even when only a window is searched
+        area = (img_h // stride) * (img_w // stride)
         # check that the image is not all black
         if number > 0:
-            if number <= img_h * img_w // 80:
+            if number <= area // 80:
                 # we probably ran off the path since >25% of the screen is white
                 self.end_count += 1
-            avg_x = np.round(avg_x / number, 0)
-            avg_y = np.round(avg_y / number, 0)
+            avg_x = np.round(avg_x, 0)
+            avg_y = np.round(avg_y, 0)
             # return the movement vector, positive col = move forward, positive row = turn right
-            return np.array([avg_x-img_w//2, avg_y-img_h])  # origin at center, bottom
+            vec = np.array([avg_x-img_w//2, avg_y-img_h])  # origin at center, bottom
+            return vec * self.preprocessor.downscale
         else:
             # image is all black, so don't move
             return np.zeros([2])
@@ -146,10 +315,28 @@ class FaceFollow:
         :param y_scale: vertical component of the COG vector
         :return: None
         """
-        left = False
-        right = False
-        forward = False
+        self.perform_action(self.choose_action(x_scale, y_scale))
 
+    def choose_action(self, x_scale, y_scale):
+        """
+        Picks the command for the COG vector, the targets from the steering controller when one
+        is set, otherwise an action from direction_to_action
+        :param x_scale: horizontal component of the COG vector
+        :param y_scale: vertical component of the COG vector
+        :return: {channel: target} dict, or one of "forward", "left", "right" or None to stop
+        """
+        if self.steering is not None:
+            return self.steering.update(x_scale, y_scale, found=self.path_pixels > 0)
+        return self.direction_to_action(x_scale, y_scale)
+
+    @staticmethod
+    def direction_to_action(x_scale, y_scale):
+        """
+        Picks the action to take from the COG vector
+        :param x_scale: horizontal component of the COG vector
+        :param y_scale: vertical component of the COG vector
+        :return: one of "forward", "left", "right" or None to stop
+        """
         min_turn_div = 0  # |x_scale| or |y_scale| must be larger then this for any action to happen
         min_forward_div = 15
 
@@ -157,67 +344,365 @@ class FaceFollow:
             # turning wins
             if x_scale > min_turn_div:
                 # want to go right
-                right = True
+                return "right"
             elif x_scale < -min_turn_div:
                 # want to go left
-                left = True
-            else:
-                # stop
-                pass
+                return "left"
         else:
             # forward wins
             if np.abs(y_scale) > min_forward_div:
                 # go forward if deviation is large enough
-                forward = True
-            else:
-                # stop
-                pass
+                return "forward"
+        # stop
+        return None
 
+    def perform_action(self, action):
+        """
+        Starts a burst of motor steps for an action from direction_to_action, the steps are
+        played by the scheduler without blocking and a newer action replaces the rest of the burst.
+        Targets from the steering controller are sent as they are
+        :param action: one of "forward", "left", "right" or None to stop, or a {channel: target} dict
+        :return: None
+        """
         if not self.end_count > 6:
-            burst = 8
-            for i in range(burst):
-                if i == burst-1 or (i >= burst - 1 and (right or left)):
-                    left = False
-                    right = False
-                    forward = False
-                if forward:
-                    self.motors -= 200
-                    if self.motors < 2500:
-                        self.motors = 2600
-                    self.tango.setTarget(self.MOTORS, self.motors)
-
-                elif left:
-                    self.turn += 200
-                    if self.turn > 7010:
-                        self.turn = 7000
-                    self.tango.setTarget(self.TURN, self.turn)
-
-                elif right:
-                    self.turn -= 200
-                    if self.turn < 3390:
-                        self.turn = 3400
-                    self.tango.setTarget(self.TURN, self.turn)
-
-                else:
-                    # stop
-                    self.motors = 6000
-                    self.turn = 6000
-                    self.tango.setTarget(self.MOTORS, self.motors)
-                    self.tango.setTarget(self.TURN, self.turn)
-                time.sleep(0.1)
+            burst = self.burst
+            if isinstance(action, dict):
+                self.scheduler.clear()
+                self.motors = action.get(self.MOTORS, self.motors)
+                self.turn = action.get(self.TURN, self.turn)
+                self.tango.setTargets(action)
+                return
+            if action is None:
+                profile = [None]
+            elif self.planner is not None:
+                # the first step sends the whole burst as one move, the rest only wait for it
+                profile = [action] + ["hold"] * (burst - 2) + [None]
+            else:
+                # hold the action for the burst then stop
+                profile = [action] * (burst - 1) + [None]
+            self.scheduler.submit(profile)
+            self.scheduler.tick()
         else:
             self.end = True
 
+    def motor_step(self, action):
+        """
+        Moves the motors one step for an action, called by the scheduler once per tick
+        :param action: one of "forward", "left", "right", "hold" to keep going or None to stop
+        :return: None
+        """
+        if action == "hold":
+            return
+        if self.planner is not None and action is not None:
+            self.glide(action)
+            return
+        if action == "forward":
+            self.motors -= 200
+            if self.motors < 2500:
+                self.motors = 2600
+            self.tango.setTarget(self.MOTORS, self.motors)
+
+        elif action == "left":
+            self.turn += 200
+            if self.turn > 7010:
+                self.turn = 7000
+            self.tango.setTarget(self.TURN, self.turn)
+
+        elif action == "right":
+            self.turn -= 200
+            if self.turn < 3390:
+                self.turn = 3400
+            self.tango.setTarget(self.TURN, self.turn)
+
+        else:
+            # stop
+            self.motors = 6000
+            self.turn = 6000
+            self.send_neutral({self.MOTORS: self.motors, self.TURN: self.turn})
+
+    def send_neutral(self, targets):
+        """
+        Sends stop targets at once, clearing the ramp a glide left on the channels first
+        :param targets: {chan: target} dict
+        :return: None
+        """
+        self.gliding = None
+        if self.planner is not None:
+            self.planner.jump(targets)
+        else:
+            self.tango.setTargets(targets)
+
+    def glide(self, action):
+        """
+        Moves the motors as far as a whole burst of steps for an action would, with one target
+        that the Maestro ramps to over the time the burst takes. While the move for an action
+        is still playing, the same action again is left to it, so a new command every frame
+        doesn't move the goal further each time and ramp faster than stepping would
+        :param action: one of "forward", "left" or "right"
+        :return: None
+        """
+        steps = self.burst - 1
+        duration = steps * self.scheduler.period
+        now = self.scheduler.clock()
+        if action == self.gliding and now < self.glide_end:
+            return
+        self.gliding = action
+        self.glide_end = now + duration
+        if action == "forward":
+            self.motors = max(self.motors - 200 * steps, 2600)
+            self.planner.move({self.MOTORS: self.motors}, duration)
+        elif action == "left":
+            self.turn = min(self.turn + 200 * steps, 7000)
+            self.planner.move({self.TURN: self.turn}, duration)
+        elif action == "right":
+            self.turn = max(self.turn - 200 * steps, 3400)
+            self.planner.move({self.TURN: self.turn}, duration)
+
+    def enable_trajectories(self, **kwargs):
+        """
+        Sends each burst as one ramped move instead of a target per step, see TrajectoryPlanner
+        for the options
+        :return: the TrajectoryPlanner
+        """
+        self.planner = TrajectoryPlanner(self.tango, **kwargs)
+        return self.planner
+
+    def enable_pid(self, **kwargs):
+        """
+        Sets the motor targets from the COG vector with a PID controller instead of stepping
+        them toward an action, see PidSteering for the options
+        :return: the PidSteering
+        """
+        self.steering = PidSteering(motors=self.MOTORS, turn=self.TURN, **kwargs)
+        return self.steering
+
     def zero_motors(self):
         self.body = 6000
         self.headTurn = 6000
         self.headTilt = 6000
         self.motors = 6000
         self.turn = 6000
+        self.scheduler.clear()
+        if self.steering is not None:
+            self.steering.pid.reset()
+        self.return_to_neutral({self.MOTORS: self.motors, self.TURN: self.turn})
+
+    def enable_auto_canny(self, **kwargs):
+        """
+        Lets the Canny thresholds follow the lighting, see AutoCanny for the options
+        :return: the AutoCanny, its metrics() has the current thresholds
+        """
+        self.auto_canny = AutoCanny(low=self.min_canny, high=self.max_canny, **kwargs)
+        return self.auto_canny
 
     def change_slider_max_canny(self, value):
+        # moving a slider takes the thresholds back to manual
+        self.auto_canny = None
         self.max_canny = value
 
     def change_slider_min_canny(self, value):
+        self.auto_canny = None
         self.min_canny = value
 
+
+class FaceFollow(LazyController):
+    """
+    Turns and tilts the head to keep a face in the middle of the frame
+
+    Haar detection is the expensive part, so it only runs every detect_every frames or when
+    the face is lost. In between, the face is tracked by matching the last detected face
+    against a small window around where it was. When a face is known, detection first scans
+    only a region around it at scales close to its size before falling back to the whole frame
+    """
+
+    def __init__(self, controller=None, window=True, detect_every=10,
+                 cascade="haarcascade_frontalface_default.xml"):
+        """
+        :param controller: maestro.Controller to send head commands to, the default port is
+                           opened when the first command is sent if not given
+        :param window: show the frames in a window, it is created with the first frame,
+                       False runs headless and draws nothing
+        :param detect_every: run the Haar detector at least this often, in frames
+        :param cascade: file name of the Haar cascade, loaded the first time a face is searched for
+        """
+        self.HEADTURN = 3
+        self.HEADTILT = 4
+        self.headTurn = 6000
+        self.headTilt = 6000
+        self.end = False
+        if controller is not None:
+            self.tango = controller
+
+        self.cascade_name = cascade
+        self.cascade = None
+        self.detect_every = detect_every
+        # faces are tracked while the template matches at least this well
+        self.min_match = 0.6
+        # head moves at most this much per frame, the same step as the keyboard
+        self.max_step = 200
+
+        self.frame = None
+        self.frame_x = 200
+        self.frame_y = 200
+        # last face as (x, y, w, h), its grayscale template and how it was found
+        self.face = None
+        self.template = None
+        self.found_by = None
+        self.frames_since_detect = 0
+        self.detections = 0
+        self.roi_detections = 0
+        self.tracked = 0
+
+        self.frame_name = "Video"
+        self.show_window = window
+        # sends some of the overlays elsewhere when set, see display.OverlayPublisher
+        self.publisher = None
+
+    def setup_controller(self, controller):
+        controller.setTargets({self.HEADTURN: self.headTurn, self.HEADTILT: self.headTilt})
+
+    def pi_cam_loop(self, image):
+        """
+        Runs 1 loop of the face search given the current frame
+        :param image: current frame to evaluate
+        :return:
+        """
+        self.process_frame(image)
+        self.show(image)
+
+    def show(self, image):
+        """
+        Shows a frame with the current face marked on it
+        :param image: frame the current face was found in
+        :return:
+        """
+        # nothing is drawn when running headless
+        if self.show_window:
+            resources.window(self.frame_name)
+            cv.imshow(self.frame_name, self.draw_overlay(image))
+        if self.publisher is not None and self.publisher.wants_frame():
+            self.publisher.publish(self.draw_overlay(image))
+
+    def process_detection(self, image, face, where):
+        """
+        Takes the face a vision_pool.VisionPool worker found in a frame instead of searching for it here
+        :param image: the frame
+        :param face: the face as (x, y, w, h), or None
+        :param where: see vision.detect_face
+        :return: the face
+        """
+        self.frame = image
+        self.frame_y, self.frame_x = image.shape[:2]
+        # the workers detect on every frame, so there is no template to track with
+        self.use_detection(None, face, where)
+        self.face = face
+        return face
+
+    def process_frame(self, image):
+        """
+        Finds the face in a frame, tracking it when possible and detecting it when needed
+        :param image: BGR frame
+        :return: the face as (x, y, w, h), or None if there is none
+        """
+        self.frame = image
+        self.frame_y, self.frame_x = image.shape[:2]
+        gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+        face = None
+        if self.face is not None and self.frames_since_detect < self.detect_every:
+            face = self.track(gray)
+            if face is not None:
+                self.found_by = "track"
+        if face is None:
+            face = self.detect(gray)
+        self.face = face
+        return face
+
+    def detect(self, gray):
+        """
+        Runs the Haar detector, first around the last face and then on the whole frame
+        :param gray: grayscale frame
+        :return: the biggest face found, or None
+        """
+        if self.cascade is None:
+            self.cascade = resources.cascade(self.cascade_name)
+        face, where = detect_face(self.cascade, gray, self.face)
+        self.use_detection(gray, face, where)
+        return face
+
+    def use_detection(self, gray, face, where):
+        """
+        Starts tracking a face found by the detector, here or in a vision.VisionPool worker
+        :param gray: grayscale frame the face was found in, None to not keep a template
+        :param face: the face as (x, y, w, h), or None
+        :param where: "near" if it was found around the last face, "full" if in the whole frame
+        :return:
+        """
+        self.frames_since_detect = 0
+        if where == "near":
+            self.roi_detections += 1
+        elif where == "full":
+            self.detections += 1
+        if face is not None:
+            x, y, w, h = face
+            self.template = gray[y:y + h, x:x + w].copy() if gray is not None else None
+            self.found_by = "detect"
+        else:
+            self.template = None
+            self.found_by = None
+
+    def track(self, gray):
+        """
+        Looks for the last detected face near where it was with template matching
+        :param gray: grayscale frame
+        :return: the face, or None if it no longer matches
+        """
+        self.frames_since_detect += 1
+        if self.template is None:
+            return None
+        th, tw = self.template.shape
+        x, y, w, h = expand_box(self.face, 0.5, gray.shape)
+        if w < tw or h < th:
+            return None
+        scores = cv.matchTemplate(gray[y:y + h, x:x + w], self.template, cv.TM_CCOEFF_NORMED)
+        _, score, _, (mx, my) = cv.minMaxLoc(scores)
+        if score < self.min_match:
+            return None
+        self.tracked += 1
+        return (x + mx, y + my, tw, th)
+
+    def perform_movement(self):
+        """
+        Turns and tilts the head toward the face found in the current frame
+        :return:
+        """
+        if self.face is None:
+            return
+        x, y, w, h = self.face
+        # offset of the face from the center as a fraction of the frame, -0.5 to 0.5
+        err_x = (x + w / 2.0) / self.frame_x - 0.5
+        err_y = (y + h / 2.0) / self.frame_y - 0.5
+        # face to the right turns the head right, which lowers headTurn like the `d` key,
+        # face above the center tilts up, which raises headTilt like the `w` key
+        self.headTurn -= int(2 * err_x * self.max_step)
+        self.headTilt -= int(2 * err_y * self.max_step)
+        self.headTurn = min(max(self.headTurn, 1510), 7900)
+        self.headTilt = min(max(self.headTilt, 1510), 7900)
+        self.tango.setTargets({self.HEADTURN: self.headTurn, self.HEADTILT: self.headTilt})
+
+    def draw_overlay(self, image):
+        """
+        :param image: frame, not changed
+        :return: copy of the frame with the face marked
+        """
+        image = image.copy()
+        if self.face is not None:
+            x, y, w, h = self.face
+            color = (0, 255, 0) if self.found_by == "detect" else (255, 0, 0)
+            cv.rectangle(image, (x, y), (x + w, y + h), color, 2)
+        return image
+
+    def zero_motors(self):
+        self.headTurn = 6000
+        self.headTilt = 6000
+        self.return_to_neutral({self.HEADTURN: self.headTurn, self.HEADTILT: self.headTilt})
@@ -1,44 +1,95 @@
 # import the necessary packages
-from picamera.array import PiRGBArray
-from picamera import PiCamera
+import argparse
+import resources
+from display import open_publisher
+from metrics import Metrics, open_exporter
 from movement import LineFollow
-import time
-import cv2
+from runtime import ThreadedRuntime
+from telemetry import TelemetryLog
+from frame_source import open_source, record
 
-# initialize the camera and grab a reference to the raw camera capture
-camera = PiCamera()
-w, h = 320, 240
-camera.resolution = (w, h)  # (640, 480)
-camera.framerate = 32
-rawCapture = PiRGBArray(camera, size=camera.resolution)
+parser = argparse.ArgumentParser(description="Follow a path seen by the camera")
+parser.add_argument("source", nargs="?", default="picamera",
+                    help="picamera, a camera index, a directory of images, a .frames recording or a video file")
+parser.add_argument("--record", metavar="FILE", help="save the frames to a .frames recording")
+parser.add_argument("--realtime", action="store_true", help="play a recording at the speed it was captured")
+parser.add_argument("--profile-startup", action="store_true",
+                    help="print how long each import and component took to set up")
+parser.add_argument("--glide", action="store_true",
+                    help="send each motor burst as one move the Maestro ramps, instead of a target per step")
+parser.add_argument("--pid", action="store_true",
+                    help="set the motor targets from the path with a PID controller, tune it with tune_steering.py")
+parser.add_argument("--auto-canny", action="store_true",
+                    help="pick the Canny thresholds from the frames instead of the fixed ones")
+parser.add_argument("--track", action="store_true",
+                    help="after the path is found, only process a window around it in the next frame")
+parser.add_argument("--headless", action="store_true", help="don't open a window or draw the overlay")
+parser.add_argument("--publish", metavar="OUTPUT",
+                    help="send some overlays to png:DIRECTORY or mjpeg:PORT from a separate thread")
+parser.add_argument("--publish-every", type=int, default=10, metavar="N",
+                    help="publish one overlay out of every N frames")
+parser.add_argument("--metrics", metavar="OUTPUT",
+                    help="export latencies and rates to log:SECONDS, json:FILE or http:PORT")
+parser.add_argument("--telemetry", metavar="FILE",
+                    help="log the direction vectors and motor targets to FILE, replay it with telemetry.py")
+parser.add_argument("--telemetry-frames", type=int, default=0, metavar="N",
+                    help="also log one frame out of every N to FILE.frames")
+args = parser.parse_args()
 
+with resources.profile.timed("source " + args.source):
+    source = open_source(args.source, realtime=args.realtime)
 
-path_follow = LineFollow()  # get movement directions from this class
+with resources.profile.timed("LineFollow"):
+    path_follow = LineFollow(window=not args.headless)  # get movement directions from this class
+if args.glide:
+    path_follow.enable_trajectories()
+if args.pid:
+    path_follow.enable_pid()
+auto_canny = None
+if args.auto_canny:
+    auto_canny = path_follow.enable_auto_canny()
+if args.track:
+    path_follow.enable_tracking()
+if args.publish:
+    path_follow.publisher = open_publisher(args.publish, args.publish_every)
+telemetry = None
+if args.telemetry:
+    telemetry = TelemetryLog(args.telemetry, frame_every=args.telemetry_frames)
+    path_follow.telemetry = telemetry
+    path_follow.tango.telemetry = telemetry
+metrics = exporter = None
+if args.metrics:
+    metrics = Metrics()
+    metrics.instrument_port(path_follow.tango)
+    if auto_canny is not None:
+        # the thresholds are levels, how often they were updated and changed are counters
+        for name in ("canny_low", "canny_high"):
+            metrics.watch(name, lambda name=name: auto_canny.metrics()[name], rate=False)
+        for name in ("canny_updates", "canny_changes"):
+            metrics.watch(name, lambda name=name: auto_canny.metrics()[name])
+    exporter = open_exporter(metrics, args.metrics)
 
-# allow the camera to warmup
-time.sleep(0.1)
+frames = iter(source)
+if args.record:
+    frames = record(frames, args.record)
 
-# capture frames from the camera
-for frame in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-    # grab the raw NumPy array representing the image, then initialize the timestamp
-    # and occupied/unoccupied text
-    image = frame.array
-    # get frame size
-    w, h = image.shape[:2]
-    # use the lower center of the image
-    x, y = w//5, h//2
-    #image = image[y:y + h//4, x:x + 3*w//5]
-
-    # do one loop
-    path_follow.pi_cam_loop(image)
-    # move
-    path_follow.perform_movement()
-
-    key = cv2.waitKey(1) & 0xFF
-    # clear the stream in preparation for the next frame
-    rawCapture.truncate(0)
-
-    # if the `q` key was pressed, break from the loop
-    if key == ord("q") or path_follow.end:
-        path_follow.zero_motors()
-        break
+# capture, vision and motor control each run on their own thread,
+# the loop ends when the `q` key is pressed or the path ends
+# frames are given back to the source once the vision thread is done with them
+try:
+    ThreadedRuntime(path_follow, frames, show=not args.headless, release=source.hold_frames(),
+                    metrics=metrics).run()
+finally:
+    source.close()
+    if exporter is not None:
+        exporter.close()
+    if path_follow.publisher is not None:
+        path_follow.publisher.close()
+    if telemetry is not None:
+        path_follow.tango.flush()
+        telemetry.close()
+    # sends whatever is still queued for the Maestro, the neutral targets from zero_motors
+    resources.close()
+    if args.profile_startup:
+        # the controller and window are set up with the first frame, so this waits until the end
+        print(resources.profile.report())
@@ -0,0 +1,82 @@
+import time
+
+
+class FramePipeline:
+    """
+    Runs the vision stages for one frame at a time and caches the output of each stage,
+    so the display and the motors can both read the same result without redoing the work
+
+    Stages, each one reads the output of the stage before it:
+    - preprocess: blur and normalize the frame
+    - edges: binary edge image of the path
+    - centroid: direction vector from the center of the image to the path
+    - command: the action or targets the motors should take
+    - overlay: edge image with the direction vector drawn on it, for display
+    """
+
+    STAGES = ("preprocess", "edges", "centroid", "command", "overlay")
+
+    def __init__(self, follower):
+        """
+        :param follower: object that provides the stage functions, see LineFollow
+        """
+        self.follower = follower
+        self.frame = None
+        self.frame_count = 0
+        # output and run time in seconds of each stage for the current frame
+        self.results = {}
+        self.timings = {}
+        # also records each stage's run time in a metrics.Metrics when set
+        self.metrics = None
+
+    def new_frame(self, image):
+        """
+        Sets the frame to evaluate and drops the cached results of the last frame
+        :param image: current frame to evaluate
+        :return:
+        """
+        self.frame = image
+        self.frame_count += 1
+        self.results.clear()
+        self.timings.clear()
+
+    def get(self, stage):
+        """
+        Gets the output of a stage for the current frame, running it and any stage before it
+        that has not been run yet
+        :param stage: name of the stage, one of STAGES
+        :return: output of the stage
+        """
+        if stage not in self.results:
+            if self.frame is None:
+                raise RuntimeError("no frame given to the pipeline, call new_frame first")
+            timed = self.total_time()
+            start = time.perf_counter()
+            self.results[stage] = self._run(stage)
+            # time spent in earlier stages run from here is recorded under their own names
+            nested = self.total_time() - timed
+            self.timings[stage] = time.perf_counter() - start - nested
+            if self.metrics is not None:
+                self.metrics.observe(stage, self.timings[stage])
+        return self.results[stage]
+
+    def _run(self, stage):
+        f = self.follower
+        if stage == "preprocess":
+            return f.preprocess(self.frame)
+        if stage == "edges":
+            return f.place_in_frame(f.find_edges(self.get("preprocess")))
+        if stage == "centroid":
+            return f.locate_path(self.get("edges"))
+        if stage == "command":
+            x_v, y_v = self.get("centroid")
+            return f.choose_action(x_v, y_v)
+        if stage == "overlay":
+            return f.draw_overlay(self.get("edges"), self.get("centroid"))
+        raise KeyError(stage)
+
+    def total_time(self):
+        """
+        :return: total time in seconds spent on the stages that ran for the current frame
+        """
+        return sum(self.timings.values())
@@ -0,0 +1,185 @@
+import atexit
+import contextlib
+import importlib
+import os
+import threading
+import time
+
+
+class StartupProfile:
+    """
+    Seconds spent importing modules and setting up each component, in the order they happened,
+    so a slow start can be traced to the part that caused it
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        """
+        :param name: what was set up, such as "import cv2" or "controller /dev/ttyACM0"
+        :param seconds: how long it took
+        :return:
+        """
+        with self.lock:
+            self.entries.append((name, seconds))
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Records how long the body of a with block takes, also when it raises
+        :param name: what the block sets up
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def total(self):
+        with self.lock:
+            return sum(seconds for _, seconds in self.entries)
+
+    def report(self):
+        """
+        :return: one line per entry and the total, in milliseconds
+        """
+        with self.lock:
+            entries = list(self.entries)
+        lines = ["  %-40s %8.1f ms" % (name, seconds * 1000) for name, seconds in entries]
+        lines.append("  %-40s %8.1f ms" % ("total", sum(seconds for _, seconds in entries) * 1000))
+        return "startup:\n" + "\n".join(lines)
+
+
+profile = StartupProfile()
+
+
+def load_module(name):
+    """
+    Imports a module and records the time in the startup profile, a module that is
+    already imported shows up as taking no time
+    :param name: module to import
+    :return: the module
+    """
+    with profile.timed("import " + name):
+        return importlib.import_module(name)
+
+
+np = load_module("numpy")
+cv = load_module("cv2")
+maestro = load_module("maestro")
+
+#
+# Process-wide caches of the expensive things a robot script needs: Haar
+# cascades, Maestro connections and display windows.  Each one is created
+# the first time it is asked for and the same object is handed out after
+# that, so headless runs and tools that never use one never pay for it.
+# Maestros are opened through one maestro.Registry, so devices chained on a
+# port share its connection.
+#
+_lock = threading.RLock()
+_cascades = {}
+_registry = None
+_windows = set()
+
+
+def cascade_paths(name):
+    """
+    :param name: file name or path of a cascade
+    :return: places the cascade is looked for, in order
+    """
+    paths = [name]
+    if not os.path.isabs(name):
+        paths.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), name))
+        data = getattr(cv, "data", None)
+        if data is not None:
+            paths.append(os.path.join(data.haarcascades, os.path.basename(name)))
+    return paths
+
+
+def cascade(name="haarcascade_frontalface_default.xml"):
+    """
+    Loads a Haar cascade once per process
+    :param name: file name of the cascade, looked for in the working directory, next to this
+                 module and in the cascades that come with OpenCV
+    :return: cv.CascadeClassifier
+    """
+    with _lock:
+        if name in _cascades:
+            return _cascades[name]
+        paths = cascade_paths(name)
+        for path in paths:
+            if os.path.isfile(path):
+                with profile.timed("cascade " + os.path.basename(path)):
+                    classifier = cv.CascadeClassifier(path)
+                if classifier.empty():
+                    raise IOError("%s is not a valid cascade file" % path)
+                _cascades[name] = classifier
+                return classifier
+        raise IOError("could not find cascade %s, looked in: %s" % (name, ", ".join(paths)))
+
+
+def registry():
+    """
+    :return: the process-wide maestro.Registry, every controller from this module is in it
+    """
+    global _registry
+    with _lock:
+        if _registry is None:
+            _registry = maestro.Registry()
+        return _registry
+
+
+def controller(tty_str='/dev/ttyACM0', device=0x0c, channels=None):
+    """
+    Opens a Maestro once per process, later calls for the same port and device get the same
+    Controller. Devices chained on one port share its connection
+    :param tty_str: serial port of the Maestro
+    :param device: Pololu device number
+    :param channels: optional {name: channel} map to add to the registry for this device
+    :return: maestro.Controller
+    """
+    name = "%s#%d" % (tty_str, device)
+    with _lock:
+        if (tty_str, device) in registry().DeviceKeys:
+            return registry().addDevice(name, tty_str, device, channels)
+        try:
+            with profile.timed("controller " + name):
+                return registry().addDevice(name, tty_str, device, channels)
+        except (OSError, maestro.serial.SerialException) as e:
+            raise IOError("could not open the Maestro on %s: %s" % (tty_str, e))
+
+
+def window(name):
+    """
+    Creates a display window once per process
+    :param name: name of the window
+    :return: the name, to pass on to cv.imshow
+    """
+    with _lock:
+        if name not in _windows:
+            with profile.timed("window " + name):
+                cv.namedWindow(name)
+            _windows.add(name)
+    return name
+
+
+def close():
+    """
+    Closes the cached controllers and windows, they are opened again when next asked for
+    :return:
+    """
+    global _registry
+    with _lock:
+        if _registry is not None:
+            _registry.close()
+            _registry = None
+        if _windows:
+            cv.destroyAllWindows()
+            _windows.clear()
+
+
+# the shared ports write from daemon threads, close them at exit so targets
+# still in their queues (such as the neutral ones sent on the way out) are sent
+atexit.register(close)
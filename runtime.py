@@ -0,0 +1,210 @@
+import threading
+import time
+import cv2 as cv
+import resources
+
+
+class LatestValue:
+    """
+    Hands values from one thread to another, keeping only the newest one.
+    A value that is replaced before it is taken is dropped, so the reader always gets fresh data
+    """
+
+    def __init__(self, on_drop=None):
+        """
+        :param on_drop: function called with each value that is replaced before it was taken
+        """
+        self._cond = threading.Condition()
+        self.on_drop = on_drop
+        self._value = None
+        self._fresh = False
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, value):
+        """
+        Stores a value, replacing any value that has not been taken yet
+        :param value: value to hand over
+        :return:
+        """
+        with self._cond:
+            stale = self._value if self._fresh else None
+            if self._fresh:
+                self.dropped += 1
+            self._value = value
+            self._fresh = True
+            self._cond.notify_all()
+        if stale is not None and self.on_drop is not None:
+            self.on_drop(stale)
+
+    def get(self, timeout=None):
+        """
+        Waits for a value that has not been taken yet
+        :param timeout: seconds to wait, None waits until a value arrives or the slot is closed
+        :return: the newest value, or None if the wait timed out or the slot was closed
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fresh or self.closed, timeout):
+                return None
+            if not self._fresh:
+                return None
+            self._fresh = False
+            return self._value
+
+    def close(self):
+        """
+        Wakes up every waiting reader, a value that was not taken yet can still be read
+        :return:
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class ThreadedRuntime:
+    """
+    Runs capture, vision and motor control on separate threads so a slow step never holds up
+    the others. The threads are joined by LatestValue slots, so stale frames and commands are
+    dropped and the motors always act on the newest image.
+    The display has to run on the main thread, see run
+    """
+
+    def __init__(self, follower, frames, show=True, release=None, metrics=None):
+        """
+        :param follower: LineFollow that provides the vision stages and the motor control
+        :param frames: iterable of BGR images, read on the capture thread
+        :param show: show the overlay of the newest processed frame, False runs headless and only
+                     draws the overlays the follower's publisher asks for
+        :param release: function called with each frame once it is processed or dropped,
+                        from FrameSource.hold_frames, so the source can reuse its buffer
+        :param metrics: metrics.Metrics to record the time spent in each thread and stage, and
+                        the frames, dropped frames and commands per second
+        """
+        self.follower = follower
+        self.frames = frames
+        self.show = show
+        self.release = release
+        self.stopping = threading.Event()
+        self.frame_slot = LatestValue(on_drop=release)
+        self.command_slot = LatestValue()
+        self.overlay_slot = LatestValue()
+        self.metrics = metrics
+        if metrics is not None:
+            follower.pipeline.metrics = metrics
+            metrics.watch("frames_dropped", lambda: self.frame_slot.dropped)
+        self.threads = [
+            threading.Thread(target=self._capture, name="capture", daemon=True),
+            threading.Thread(target=self._vision, name="vision", daemon=True),
+            threading.Thread(target=self._actuate, name="actuate", daemon=True),
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _capture(self):
+        metrics = self.metrics
+        try:
+            start = time.perf_counter()
+            for image in self.frames:
+                if self.stopping.is_set():
+                    break
+                if metrics is not None:
+                    # time waiting for the source, the frame interval for a camera
+                    now = time.perf_counter()
+                    metrics.observe("capture", now - start)
+                    metrics.count("frames_captured")
+                    start = now
+                self.frame_slot.put(image)
+        finally:
+            # closing lets the other threads finish the last frame and exit
+            self.frame_slot.close()
+
+    def _vision(self):
+        pipeline = self.follower.pipeline
+        metrics = self.metrics
+        try:
+            while not self.stopping.is_set():
+                image = self.frame_slot.get()
+                if image is None:
+                    break
+                start = time.perf_counter()
+                self.follower.process_frame(image)
+                self.command_slot.put((pipeline.frame_count, pipeline.get("command")))
+                if self.show:
+                    self.overlay_slot.put(pipeline.get("overlay"))
+                publisher = self.follower.publisher
+                if publisher is not None and publisher.wants_frame():
+                    publisher.publish(pipeline.get("overlay"))
+                if self.release is not None:
+                    self.release(image)
+                if metrics is not None:
+                    metrics.observe("vision", time.perf_counter() - start)
+                    metrics.count("frames")
+        finally:
+            self.command_slot.close()
+            self.overlay_slot.close()
+
+    def _actuate(self):
+        scheduler = self.follower.scheduler
+        metrics = self.metrics
+        try:
+            while not self.stopping.is_set():
+                command = self.command_slot.get(timeout=scheduler.period)
+                if command is None:
+                    if self.command_slot.closed:
+                        if scheduler.idle:
+                            break
+                        # get returns at once from a closed slot, so sleep until the next step is due
+                        self.stopping.wait(max(0.0, scheduler.next_due - scheduler.clock()))
+                    # no new frame yet, keep playing the current burst
+                    scheduler.tick()
+                    continue
+                _, action = command
+                start = time.perf_counter()
+                self.follower.perform_action(action)
+                if metrics is not None:
+                    metrics.observe("actuate", time.perf_counter() - start)
+                    metrics.count("commands")
+                if self.follower.end:
+                    break
+        finally:
+            self.stopping.set()
+
+    def run(self, window_name=None):
+        """
+        Starts the threads and shows the newest overlay until `q` is pressed,
+        the follower ran off the path or the frames run out. Headless runs stop on Ctrl-C instead of `q`
+        :param window_name: name of the window to show the overlay in
+        :return:
+        """
+        window_name = window_name or self.follower.frame_name
+        if self.show:
+            resources.window(window_name)
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                if self.show:
+                    overlay = self.overlay_slot.get(timeout=0.1)
+                    if overlay is not None:
+                        cv.imshow(window_name, overlay)
+                    if cv.waitKey(1) & 0xFF == ord("q"):
+                        break
+                else:
+                    self.stopping.wait(0.1)
+        finally:
+            self.stop()
+
+    def stop(self, timeout=2.0):
+        """
+        Stops all threads and sends the motors to neutral
+        :param timeout: seconds to wait for each thread
+        :return:
+        """
+        self.stopping.set()
+        for slot in (self.frame_slot, self.command_slot, self.overlay_slot):
+            slot.close()
+        for thread in self.threads:
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join(timeout)
+        self.follower.zero_motors()
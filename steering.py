@@ -0,0 +1,156 @@
+import time
+import numpy as np
+
+
+class PidController:
+    """
+    PID controller over NumPy arrays, every gain, limit and error is an array so several axes,
+    or several sets of gains for tuning, are updated in one call
+
+    The integral stops growing on any axis whose output is saturated in the direction of its
+    error, so it doesn't wind up while the output is pinned at a limit. The derivative is low-pass
+    filtered with time constant derivative_tau, as it amplifies the noise in the error. Updates
+    closer together than period keep the last output, so the output changes at a fixed rate
+    however fast the errors come in
+    """
+
+    def __init__(self, kp, ki=0.0, kd=0.0, out_min=-np.inf, out_max=np.inf, integral_limit=np.inf,
+                 derivative_tau=0.05, period=0.0, max_dt=0.5, clock=time.monotonic):
+        """
+        :param kp: proportional gains
+        :param ki: integral gains, per second
+        :param kd: derivative gains, in seconds
+        :param out_min: lowest output of each axis
+        :param out_max: highest output of each axis
+        :param integral_limit: largest magnitude of the integral term of each axis
+        :param derivative_tau: seconds, time constant of the derivative filter, 0 doesn't filter
+        :param period: least seconds between updates, 0 updates on every call
+        :param max_dt: longest step in seconds, so a stall doesn't dump a large step into the integral
+        :param clock: function returning the current time in seconds
+        """
+        self.kp, self.ki, self.kd, self.out_min, self.out_max, self.integral_limit = np.broadcast_arrays(
+            *[np.asarray(v, float) for v in (kp, ki, kd, out_min, out_max, integral_limit)])
+        self.derivative_tau = derivative_tau
+        self.period = period
+        self.max_dt = max_dt
+        self.clock = clock
+        self.updates = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the integral, the derivative and the last error, the next update is like the first
+        :return:
+        """
+        self.integral = np.zeros(self.kp.shape)
+        self.derivative = np.zeros(self.kp.shape)
+        self.last_error = None
+        self.last_time = None
+        self.output = np.clip(np.zeros(self.kp.shape), self.out_min, self.out_max)
+
+    def update(self, error, now=None):
+        """
+        :param error: error of each axis, broadcast against the gains
+        :param now: current time, read from the clock if not given
+        :return: output of each axis, the last output if called again within period
+        """
+        if now is None:
+            now = self.clock()
+        if self.last_time is not None and now - self.last_time < self.period:
+            return self.output
+        error = np.broadcast_to(np.asarray(error, float), self.kp.shape)
+        if self.last_time is None:
+            dt = 0.0
+        else:
+            dt = min(now - self.last_time, self.max_dt)
+        if self.last_error is not None and dt > 0:
+            raw = (error - self.last_error) / dt
+            alpha = dt / (self.derivative_tau + dt)
+            self.derivative += alpha * (raw - self.derivative)
+        integral = np.clip(self.integral + self.ki * error * dt, -self.integral_limit, self.integral_limit)
+        output = self.kp * error + integral + self.kd * self.derivative
+        # conditional integration: keep the old integral where the output is pinned and the
+        # error pushes it further past the limit
+        winding = ((output > self.out_max) & (error > 0)) | ((output < self.out_min) & (error < 0))
+        self.integral = np.where(winding, self.integral, integral)
+        output = self.kp * error + self.integral + self.kd * self.derivative
+        self.output = np.clip(output, self.out_min, self.out_max)
+        self.last_error = error.copy()
+        self.last_time = now
+        self.updates += 1
+        return self.output
+
+
+class PidSteering:
+    """
+    Turns the direction vector from LineFollow.get_direction_vector straight into MOTORS and
+    TURN targets, instead of picking an action and stepping the targets toward it
+
+    The forward error is how far ahead the path is and the turn error how far it is to the
+    side, both in frame pixels. Each one goes through its own axis of a PidController whose
+    output is the distance of the target below center, which is forward for the motors and
+    right for the turn. A target that moves less than deadband from the one last returned keeps
+    the old value, so noise in the vector doesn't turn into serial writes
+    """
+
+    def __init__(self, motors=1, turn=2, center=6000, motors_range=(2600, 6000), turn_range=(3400, 7000),
+                 kp=(30.0, 15.0), ki=(0.0, 5.0), kd=(0.0, 1.0), derivative_tau=0.1, rate=10.0,
+                 deadband=25, clock=time.monotonic):
+        """
+        :param motors: channel of the drive motors
+        :param turn: channel of the turn motors
+        :param center: target that stops both
+        :param motors_range: (min, max) motors target, min is full speed forward
+        :param turn_range: (min, max) turn target, min is full right
+        :param kp: (forward, turn) proportional gains, target units per pixel
+        :param ki: (forward, turn) integral gains, target units per pixel second
+        :param kd: (forward, turn) derivative gains, target units per pixel per second
+        :param derivative_tau: seconds, time constant of the derivative filter
+        :param rate: most target updates per second, 0 updates on every frame
+        :param deadband: smallest change of a target that is passed on, in target units
+        :param clock: function returning the current time in seconds
+        """
+        self.motors = motors
+        self.turn = turn
+        self.center = center
+        self.deadband = deadband
+        low = np.array((motors_range[0], turn_range[0]), float)
+        high = np.array((motors_range[1], turn_range[1]), float)
+        self.pid = PidController(kp, ki, kd, out_min=center - high, out_max=center - low,
+                                 derivative_tau=derivative_tau, period=1.0 / rate if rate else 0.0,
+                                 clock=clock)
+        self.targets = np.full(self.pid.kp.shape, center, int)
+
+    def stop(self):
+        """
+        :return: {channel: target} that stops the motors
+        """
+        return {self.motors: self.center, self.turn: self.center}
+
+    def update(self, x, y, found=True, now=None):
+        """
+        :param x: horizontal component of the direction vector, positive is right
+        :param y: vertical component of the direction vector, negative is ahead
+        :param found: False when no path was seen, the motors stop and the controller resets
+        :param now: current time, read from the clock if not given
+        :return: {channel: target} for the motors and turn
+        """
+        if not found:
+            self.pid.reset()
+            self.targets.fill(self.center)
+            return self.stop()
+        self.hold(np.rint(self.center - self.pid.update((-y, x), now)).astype(int))
+        forward, right = self.targets
+        return {self.motors: int(forward), self.turn: int(right)}
+
+    def hold(self, targets):
+        """
+        Takes the new targets that moved at least deadband, and any that reached center or a limit
+        :param targets: new targets, the same shape as the gains
+        :return: the targets kept
+        """
+        limit = (targets == self.center) | (targets == self.center - self.pid.out_min) | \
+            (targets == self.center - self.pid.out_max)
+        moved = (np.abs(targets - self.targets) >= self.deadband) | limit
+        self.targets = np.where(moved, targets, self.targets)
+        return self.targets
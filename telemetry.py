@@ -0,0 +1,288 @@
+# Telemetry log of a run: the direction vector of every frame, every target
+# written to the Maestro and, optionally, every n-th frame.  Records are
+# fixed size, so a log can be memory-mapped and scanned with NumPy, and they
+# are written by a background thread so logging stays off the control loop.
+# Frames go to a .frames recording next to the log, see frame_source.
+#
+# usage: python telemetry.py LOG                       summary of a log
+#        python telemetry.py LOG --commands [--port P] replay the targets into a Maestro
+#        python telemetry.py LOG --frames              replay the frames through LineFollow
+#        add --speed N to replay N times faster than recorded, 0 for as fast as possible
+import argparse
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from frame_source import FrameRecorder, RecordedSource
+
+TELEMETRY_MAGIC = b"TLOG"
+TELEMETRY_HEADER = struct.Struct("<4sII")
+TELEMETRY_HEADER_SIZE = 64
+
+# record kinds
+VECTOR = 1
+TARGET = 2
+FRAME = 3
+
+# one record, the fields used depend on the kind:
+# VECTOR: frame number, x and y of the direction vector, count of path pixels
+# TARGET: channel and target
+# FRAME: frame number, count is the index of the frame in the .frames recording
+record_dtype = np.dtype([
+    ("timestamp", "<f8"),
+    ("kind", "u1"),
+    ("channel", "u1"),
+    ("target", "<u2"),
+    ("frame", "<u4"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("count", "<u4"),
+])
+
+
+def frames_path(path):
+    """
+    :param path: telemetry log
+    :return: the .frames recording that goes with it
+    """
+    return path + ".frames"
+
+
+class TelemetryLog:
+    """
+    Appends records to a telemetry log from a writer thread. The log_ methods only queue a tuple,
+    the records are packed and written in batches on the thread
+    """
+
+    def __init__(self, path, frame_every=0, batch=256):
+        """
+        :param path: file to write, replaced if it exists
+        :param frame_every: also save every frame_every-th frame, 0 saves none
+        :param batch: most records packed into one write
+        """
+        self.path = path
+        self.frame_every = frame_every
+        self.batch = batch
+        self.file = open(path, "wb")
+        header = TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, 1, record_dtype.itemsize)
+        self.file.write(header.ljust(TELEMETRY_HEADER_SIZE, b"\0"))
+        self.recorder = None
+        # every saved frame has the shape of the first one, a recording can't hold others
+        self.frame_shape = None
+        self.frames_seen = 0
+        self.frames_saved = 0
+        self.frames_skipped = 0
+        self.records = 0
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write, name="telemetry", daemon=True)
+        self.thread.start()
+
+    def log_vector(self, frame, x, y, count=0):
+        """
+        :param frame: frame number
+        :param x: horizontal component of the direction vector
+        :param y: vertical component of the direction vector
+        :param count: number of path pixels found
+        """
+        self.queue.put((time.monotonic(), VECTOR, 0, 0, frame, x, y, count, None))
+
+    def log_target(self, chan, target):
+        """
+        :param chan: servo channel
+        :param target: target written to it
+        """
+        self.queue.put((time.monotonic(), TARGET, chan, target, 0, 0.0, 0.0, 0, None))
+
+    def log_frame(self, frame, image):
+        """
+        Saves a copy of every frame_every-th frame, frames of another shape than the first
+        one saved are skipped
+        :param frame: frame number
+        :param image: the frame, copied if it is saved
+        :return: True if the frame is saved
+        """
+        if not self.frame_every:
+            return False
+        self.frames_seen += 1
+        if (self.frames_seen - 1) % self.frame_every:
+            return False
+        if self.frame_shape is None:
+            self.frame_shape = image.shape
+        elif image.shape != self.frame_shape:
+            self.frames_skipped += 1
+            return False
+        self.queue.put((time.monotonic(), FRAME, 0, 0, frame, 0.0, 0.0, 0, image.copy()))
+        return True
+
+    def _write(self):
+        records = np.zeros(self.batch, record_dtype)
+        done = False
+        while not done:
+            items = [self.queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            n = 0
+            for item in items:
+                if item is None:
+                    done = True
+                    continue
+                image = item[-1]
+                if image is not None:
+                    if self.recorder is None:
+                        self.recorder = FrameRecorder(frames_path(self.path), image.shape)
+                    self.recorder.write(image, item[0])
+                    item = item[:7] + (self.frames_saved, None)
+                    self.frames_saved += 1
+                records[n] = item[:8]
+                n += 1
+            if n:
+                self.file.write(records[:n].tobytes())
+                # a crash loses at most the last batch
+                self.file.flush()
+                self.records += n
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TelemetryReader:
+    """
+    A telemetry log memory-mapped as a NumPy record array
+    """
+
+    def __init__(self, path):
+        """
+        :param path: log to read
+        """
+        with open(path, "rb") as f:
+            magic, version, size = TELEMETRY_HEADER.unpack(f.read(TELEMETRY_HEADER.size))
+        if magic != TELEMETRY_MAGIC:
+            raise IOError("%s is not a telemetry log" % path)
+        if size != record_dtype.itemsize:
+            raise IOError("%s has %d byte records, expected %d" % (path, size, record_dtype.itemsize))
+        self.path = path
+        self.records = np.memmap(path, record_dtype, mode="r", offset=TELEMETRY_HEADER_SIZE)
+
+    def kind(self, kind):
+        """
+        :param kind: VECTOR, TARGET or FRAME
+        :return: the records of that kind, in the order they were logged
+        """
+        return self.records[self.records["kind"] == kind]
+
+    def frames(self, **kwargs):
+        """
+        :param kwargs: passed on to RecordedSource, such as realtime and speed
+        :return: RecordedSource of the saved frames
+        """
+        return RecordedSource(frames_path(self.path), **kwargs)
+
+    def summary(self):
+        records = self.records
+        if not len(records):
+            return "empty log"
+        seconds = records["timestamp"][-1] - records["timestamp"][0]
+        targets = self.kind(TARGET)
+        lines = ["%d records over %.1f s" % (len(records), seconds),
+                 "  %d vectors, %d targets, %d frames" % (
+                     len(self.kind(VECTOR)), len(targets), len(self.kind(FRAME)))]
+        for chan in np.unique(targets["channel"]):
+            values = targets["target"][targets["channel"] == chan]
+            lines.append("  channel %2d: %d targets, %d to %d" % (chan, len(values), values.min(), values.max()))
+        return "\n".join(lines)
+
+
+def replay_targets(records, controller, speed=1.0, sleep=time.sleep):
+    """
+    Writes logged targets to a controller with the same spacing in time
+    :param records: TARGET records, from TelemetryReader.kind(TARGET)
+    :param controller: maestro.Controller to write to
+    :param speed: how many times faster than recorded, 0 for no waiting
+    :param sleep: function to wait a number of seconds
+    :return: number of targets written
+    """
+    if not len(records):
+        return 0
+    first = records["timestamp"][0]
+    start = time.monotonic()
+    for record in records:
+        if speed > 0:
+            delay = (record["timestamp"] - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+        controller.setTarget(int(record["channel"]), int(record["target"]))
+    return len(records)
+
+
+def replay_frames(reader, follower, speed=0):
+    """
+    Runs the saved frames through a follower's vision stages
+    :param reader: TelemetryReader
+    :param follower: LineFollow, its motor commands are not sent
+    :param speed: how many times faster than recorded, 0 for as fast as possible
+    :return: list of (frame number, logged vector, new vector), logged is None if the frame has no vector
+    """
+    vectors = reader.kind(VECTOR)
+    logged = dict((int(r["frame"]), (float(r["x"]), float(r["y"]))) for r in vectors)
+    numbers = reader.kind(FRAME)["frame"]
+    source = reader.frames(realtime=speed > 0, speed=speed or 1.0)
+    results = []
+    for number, image in zip(numbers, source):
+        follower.process_frame(image)
+        x, y = follower.pipeline.get("centroid")
+        results.append((int(number), logged.get(int(number)), (float(x), float(y))))
+    source.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize or replay a telemetry log")
+    parser.add_argument("log")
+    parser.add_argument("--commands", action="store_true", help="write the logged targets to a Maestro")
+    parser.add_argument("--frames", action="store_true", help="run the saved frames through LineFollow")
+    parser.add_argument("--port", help="serial port of the Maestro, a simulated one if not given")
+    parser.add_argument("--speed", type=float, default=10.0,
+                        help="replay this many times faster than recorded, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    reader = TelemetryReader(args.log)
+    print(reader.summary())
+    if args.commands:
+        import maestro
+        if args.port:
+            controller = maestro.Controller(args.port)
+        else:
+            from maestro_sim import SimulatedMaestro
+            controller = maestro.Controller(usb=SimulatedMaestro())
+        start = time.monotonic()
+        count = replay_targets(reader.kind(TARGET), controller, args.speed)
+        print("replayed %d targets in %.2f s" % (count, time.monotonic() - start))
+        controller.close()
+    if args.frames:
+        import maestro
+        from maestro_sim import SimulatedMaestro
+        from movement import LineFollow
+        follower = LineFollow(controller=maestro.Controller(usb=SimulatedMaestro()), window=False)
+        results = replay_frames(reader, follower, args.speed)
+        changed = [r for r in results if r[1] is not None and np.hypot(r[1][0] - r[2][0], r[1][1] - r[2][1]) > 0.5]
+        print("replayed %d frames, %d vectors differ from the log" % (len(results), len(changed)))
+        for number, old, new in changed[:10]:
+            print("  frame %d: logged (%.1f, %.1f), now (%.1f, %.1f)" % (number, old[0], old[1], new[0], new[1]))
+
+
+if __name__ == "__main__":
+    main()
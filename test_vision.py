@@ -0,0 +1,198 @@
+# Checks the moments based find_centroid and get_direction_vector against the
+# per-pixel loop get_direction_vector used before, on the images in images/.
+#
+# usage: python -m pytest test_vision.py  (or python -m unittest test_vision)
+import os
+import unittest
+import cv2 as cv
+import numpy as np
+import maestro
+import movement
+from maestro_sim import SimulatedMaestro
+from vision import find_centroid, Preprocessor, ScratchBuffers
+
+IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+NAMES = ("001.png", "002.png", "test.png")
+THRESHOLDS = ((247, 255), (100, 200), (50, 150))
+
+
+def load(name):
+    image = cv.imread(os.path.join(IMAGES, name))
+    if image is None:
+        raise IOError("could not read %s" % name)
+    return image
+
+
+def baseline_edges(image, low, high):
+    """
+    The edge image of the colour detect_line the repo started with
+    :param image: BGR frame
+    :param low: lower Canny threshold
+    :param high: upper Canny threshold
+    :return: binary edge image
+    """
+    edges = np.zeros(image.shape, np.uint8)
+    # normalize image, this is for changing room lighting
+    cv.normalize(image, edges, 0, 255, cv.NORM_MINMAX)
+    edges = cv.Canny(edges, low, high)
+    return cv.dilate(edges, np.ones((2, 2)))
+
+
+def loop_centroid(bin_img):
+    """
+    The per-pixel loop get_direction_vector used before find_centroid, kept as the reference
+    :param bin_img: a binary image of the path
+    :return: (sum of x, sum of y, number of white pixels)
+    """
+    avg_x, avg_y = 0, 0
+    number = 0
+    # rows as lists so the loop takes seconds instead of minutes, the logic is unchanged
+    for y, row in enumerate(bin_img.tolist()):
+        for x in range(len(row)):
+            # binary image so anything with a high value is taken as white
+            if row[x] > 255/2:
+                avg_x += x
+                avg_y += y
+                number += 1
+    return avg_x, avg_y, number
+
+
+def loop_direction_vector(bin_img):
+    """
+    :param bin_img: a binary image of the path
+    :return: (vector, 1 if the old off-path check counted this image else 0)
+    """
+    img_h, img_w = bin_img.shape
+    avg_x, avg_y, number = loop_centroid(bin_img)
+    end_count = 0
+    if number > 0:
+        if number <= img_h * img_w // 80:
+            end_count += 1
+        avg_x = np.round(avg_x / number, 0)
+        avg_y = np.round(avg_y / number, 0)
+        return np.array([avg_x-img_w//2, avg_y-img_h]), end_count
+    return np.zeros([2]), end_count
+
+
+def follower():
+    return movement.LineFollow(controller=maestro.Controller(usb=SimulatedMaestro()), window=False)
+
+
+class DirectionVectorTest(unittest.TestCase):
+
+    def edge_images(self):
+        for name in NAMES:
+            image = load(name)
+            for low, high in THRESHOLDS:
+                yield name, (low, high), baseline_edges(image, low, high)
+
+    def test_matches_pixel_loop(self):
+        for name, thresholds, edges in self.edge_images():
+            with self.subTest(image=name, thresholds=thresholds):
+                f = follower()
+                expected, end_count = loop_direction_vector(edges)
+                np.testing.assert_array_equal(f.get_direction_vector(edges), expected)
+                self.assertEqual(f.end_count, end_count)
+
+    def test_roi_offset(self):
+        for name, thresholds, edges in self.edge_images():
+            h, w = edges.shape
+            roi = (w // 5, h // 3, w // 2, h // 2)
+            x0, y0, rw, rh = roi
+            with self.subTest(image=name, thresholds=thresholds):
+                sum_x, sum_y, number = loop_centroid(edges[y0:y0 + rh, x0:x0 + rw])
+                cog_x, cog_y, found, area = find_centroid(edges, roi)
+                self.assertEqual(found, number)
+                self.assertEqual(area, rw * rh)
+                if number:
+                    self.assertAlmostEqual(cog_x, sum_x / number + x0, places=6)
+                    self.assertAlmostEqual(cog_y, sum_y / number + y0, places=6)
+                    # the vector is still from the bottom center of the whole image
+                    expected = np.array([np.round(sum_x / number + x0) - w // 2,
+                                         np.round(sum_y / number + y0) - h])
+                    np.testing.assert_array_equal(follower().get_direction_vector(edges, roi=roi), expected)
+
+    def test_stride(self):
+        for name, thresholds, edges in self.edge_images():
+            for stride in (2, 3):
+                with self.subTest(image=name, thresholds=thresholds, stride=stride):
+                    sampled = edges[::stride, ::stride]
+                    sum_x, sum_y, number = loop_centroid(sampled)
+                    cog_x, cog_y, found, area = find_centroid(edges, stride=stride)
+                    self.assertEqual(found, number)
+                    self.assertEqual(area, sampled.size)
+                    if number:
+                        self.assertAlmostEqual(cog_x, sum_x / number * stride, places=6)
+                        self.assertAlmostEqual(cog_y, sum_y / number * stride, places=6)
+
+
+class GrayscaleTest(unittest.TestCase):
+    """
+    The preprocessor works on one channel by default, which finds slightly different edges
+    than the colour image the repo started with. The path has to stay where it was
+    """
+
+    # largest distance in pixels between the grayscale and the colour COG, measured on each
+    # image over THRESHOLDS with a couple of pixels to spare
+    MAX_SHIFT = {"001.png": 10, "002.png": 20, "test.png": 2}
+
+    def test_centroid_near_colour_baseline(self):
+        for name in NAMES:
+            image = load(name)
+            for low, high in THRESHOLDS:
+                with self.subTest(image=name, thresholds=(low, high)):
+                    expected = follower().get_direction_vector(baseline_edges(image, low, high))
+                    f = follower()
+                    self.assertTrue(f.preprocessor.grayscale)
+                    f.min_canny, f.max_canny = low, high
+                    f.process_frame(image)
+                    vec = f.pipeline.get("centroid")
+                    self.assertLessEqual(np.hypot(*(vec - expected)), self.MAX_SHIFT[name])
+                    # and the robot does the same thing
+                    self.assertEqual(f.direction_to_action(*vec), f.direction_to_action(*expected))
+
+
+class TrackingTest(unittest.TestCase):
+    """
+    A still frame has to give the same vector with tracking as without, frame after frame
+    """
+
+    PREPROCESSORS = ({}, {"downscale": 2}, {"blur": (5, 5)})
+
+    def test_window_normalized_like_frame(self):
+        for name in NAMES:
+            image = load(name)
+            for options in self.PREPROCESSORS:
+                with self.subTest(image=name, options=options):
+                    pre = Preprocessor(**options)
+                    full = pre.apply(image, ScratchBuffers()).copy()
+                    h, w = full.shape[:2]
+                    x, y, rw, rh = w // 5, h // 3, w // 2, h // 2
+                    window = pre.apply(image, ScratchBuffers(), (x, y, rw, rh))
+                    np.testing.assert_array_equal(window, full[y:y + rh, x:x + rw])
+
+    def test_tracked_matches_full_frame(self):
+        for name in NAMES:
+            image = load(name)
+            for low, high in THRESHOLDS:
+                for options in self.PREPROCESSORS:
+                    with self.subTest(image=name, thresholds=(low, high), options=options):
+                        full, tracked = follower(), follower()
+                        tracked.enable_tracking()
+                        windows = []
+                        for f in (full, tracked):
+                            f.preprocessor = Preprocessor(**options)
+                            f.min_canny, f.max_canny = low, high
+                        full.process_frame(image)
+                        expected = full.pipeline.get("centroid")
+                        for _ in range(4):
+                            tracked.process_frame(image)
+                            np.testing.assert_array_equal(tracked.pipeline.get("centroid"), expected)
+                            self.assertEqual(tracked.path_pixels, full.path_pixels)
+                            windows.append(tracked.window)
+                        # the window settles on the path instead of walking off
+                        self.assertEqual(len(set(windows[1:])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
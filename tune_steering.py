@@ -0,0 +1,206 @@
+# Replays the direction vectors of a recorded run through the PID steering
+# controller with every combination of the turn gains given, and through the
+# stepping controller LineFollow uses without it, and reports for each one
+# how long the turn target takes to settle after the path moves and how many
+# motor commands it sends per meter driven.
+# The vectors come from a telemetry log, or from running the vision stages
+# over a .frames recording or a directory of images.  Needs no camera,
+# Maestro or display.
+#
+# The recorded path doesn't react to the replayed commands, so the settle
+# time is how fast the command settles after a change in the error, not how
+# fast the robot gets back on the line.  Compare gains on the same recording.
+#
+# usage: python tune_steering.py RUN [--kp 10,15,20] [--ki 0,2,5] [--kd 0,1]
+import argparse
+import itertools
+import struct
+import numpy as np
+import maestro
+from frame_source import RecordedSource, open_source
+from maestro_sim import SimulatedMaestro
+from movement import LineFollow
+from steering import PidSteering
+from telemetry import VECTOR, TelemetryReader
+
+# forward speed in meters per second at the full speed motors target, a guess,
+# measure the robot and pass --full-speed for real distances
+FULL_SPEED = 0.5
+
+
+def load_vectors(spec, fps=30.0):
+    """
+    :param spec: telemetry log, .frames recording or directory of images
+    :param fps: frame rate of image directories, which have no timestamps
+    :return: (times, x, y, found) arrays with one entry per frame
+    """
+    try:
+        vectors = TelemetryReader(spec).kind(VECTOR)
+    except (IOError, struct.error):
+        vectors = None
+    if vectors is not None:
+        return (np.array(vectors["timestamp"]), np.array(vectors["x"], float),
+                np.array(vectors["y"], float), np.array(vectors["count"]) > 0)
+    follower = LineFollow(controller=maestro.Controller(usb=SimulatedMaestro()), window=False)
+    rows = []
+    with open_source(spec) as source:
+        for image in source:
+            follower.process_frame(image)
+            x, y = follower.pipeline.get("centroid")
+            rows.append((x, y, follower.path_pixels > 0))
+        if isinstance(source, RecordedSource):
+            times = np.array(source.records["timestamp"][:len(rows)])
+        else:
+            times = np.arange(len(rows)) / fps
+    x, y, found = (np.array(column) for column in zip(*rows))
+    return times, x.astype(float), y.astype(float), found.astype(bool)
+
+
+def simulate_pid(times, x, y, found, kp, ki, kd, **kwargs):
+    """
+    Runs every set of gains over the vectors at once
+    :param times: frame times in seconds
+    :param x: horizontal components of the direction vectors
+    :param y: vertical components of the direction vectors
+    :param found: whether the path was seen in each frame
+    :param kp: (sets, 2) array of (forward, turn) proportional gains, ki and kd the same
+    :param kwargs: passed on to PidSteering
+    :return: (frames, sets, 2) array of the (motors, turn) targets after each frame
+    """
+    steering = PidSteering(kp=kp, ki=ki, kd=kd, **kwargs)
+    pid, center = steering.pid, steering.center
+    targets = np.empty((len(times),) + pid.kp.shape, int)
+    for k in range(len(times)):
+        if found[k]:
+            targets[k] = steering.hold(np.rint(center - pid.update((-y[k], x[k]), times[k])).astype(int))
+        else:
+            pid.reset()
+            steering.targets.fill(center)
+            targets[k] = center
+    return targets
+
+
+def simulate_steps(times, x, y, found):
+    """
+    Runs the vectors through LineFollow's own stepping controller, with the motor bursts played
+    on the recording's clock
+    :param times: frame times in seconds
+    :param x: horizontal components of the direction vectors
+    :param y: vertical components of the direction vectors
+    :param found: whether the path was seen in each frame
+    :return: (times, targets) with the (motors, turn) targets after every frame and burst step,
+             targets has the same shape as from simulate_pid with one set
+    """
+    now = [times[0]]
+    follower = LineFollow(controller=maestro.Controller(usb=SimulatedMaestro()), window=False)
+    scheduler = follower.scheduler
+    scheduler.clock = lambda: now[0]
+    samples = []
+    for k in range(len(times)):
+        now[0] = times[k]
+        follower.perform_action(follower.direction_to_action(x[k], y[k]))
+        follower.end_count = 0
+        samples.append((now[0], follower.motors, follower.turn))
+        end = times[k + 1] if k + 1 < len(times) else times[k] + scheduler.period * follower.burst
+        while not scheduler.idle and scheduler.next_due < end:
+            now[0] = scheduler.next_due
+            scheduler.tick()
+            samples.append((now[0], follower.motors, follower.turn))
+    samples = np.array(samples)
+    return samples[:, 0], samples[:, None, 1:].astype(int)
+
+
+def evaluate(times, targets, steps, center=6000, band=100, full_speed=FULL_SPEED, motors_range=(2600, 6000)):
+    """
+    Scores the targets of one or more controllers, each target is held until the next sample
+    :param times: sample times in seconds
+    :param targets: (samples, sets, 2) array of (motors, turn) targets
+    :param steps: times the error jumped, each one starts a segment the turn target settles in
+    :param center: target that stops the motors
+    :param band: the turn target has settled once it stays this close to where the segment ends
+    :param full_speed: meters per second at the lowest motors target
+    :param motors_range: (min, max) motors target
+    :return: dict of arrays with one entry per set: commands, meters, commands_per_meter and
+             settle (mean seconds, nan when no segment settled)
+    """
+    # a buffered controller only writes targets that changed
+    previous = np.concatenate([np.full((1,) + targets.shape[1:], center), targets[:-1]])
+    commands = (targets != previous).sum(axis=(0, 2))
+    held = np.diff(times, append=times[-1])
+    speed = (center - targets[:, :, 0]) / float(center - motors_range[0]) * full_speed
+    meters = (speed * held[:, None]).sum(axis=0)
+
+    settles = []
+    bounds = list(steps) + [times[-1] + 1.0]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        index = np.nonzero((times >= start) & (times < end))[0]
+        if len(index) < 2:
+            continue
+        turn = targets[index, :, 1]
+        outside = np.abs(turn - turn[-1]) > band
+        # first sample after the last one outside the band
+        last = np.where(outside.any(axis=0), len(index) - 1 - np.argmax(outside[::-1], axis=0), -1)
+        settles.append(times[index[np.minimum(last + 1, len(index) - 1)]] - start)
+    settle = np.mean(settles, axis=0) if settles else np.full(targets.shape[1], np.nan)
+    with np.errstate(divide="ignore"):
+        per_meter = np.where(meters > 0, commands / np.maximum(meters, 1e-9), np.inf)
+    return {"commands": commands, "meters": meters, "commands_per_meter": per_meter, "settle": settle}
+
+
+def error_steps(times, x, found, jump=40.0):
+    """
+    :param jump: pixels the horizontal error has to move between frames to count as a step
+    :return: times of the first frame and of every frame where the path jumped, was found or was lost
+    """
+    moved = np.abs(np.diff(x)) > jump
+    changed = found[1:] != found[:-1]
+    return np.concatenate([times[:1], times[1:][moved | changed]])
+
+
+def parse_list(text):
+    return [float(v) for v in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the PID steering gains on a recorded run")
+    parser.add_argument("run", help="telemetry log, .frames recording or directory of images")
+    parser.add_argument("--kp", type=parse_list, default=[10.0, 15.0, 20.0], help="turn proportional gains to try")
+    parser.add_argument("--ki", type=parse_list, default=[0.0, 2.0, 5.0], help="turn integral gains to try")
+    parser.add_argument("--kd", type=parse_list, default=[0.0, 1.0], help="turn derivative gains to try")
+    parser.add_argument("--forward-kp", type=float, default=30.0, help="forward proportional gain")
+    parser.add_argument("--rate", type=float, default=10.0, help="target updates per second, 0 for every frame")
+    parser.add_argument("--deadband", type=int, default=25, help="smallest target change sent")
+    parser.add_argument("--fps", type=float, default=30.0, help="frame rate of an image directory")
+    parser.add_argument("--band", type=float, default=100, help="turn targets within this of the end have settled")
+    parser.add_argument("--full-speed", type=float, default=FULL_SPEED,
+                        help="meters per second at full forward, to turn targets into distance")
+    parser.add_argument("--top", type=int, default=10, help="gain sets to list")
+    args = parser.parse_args()
+
+    times, x, y, found = load_vectors(args.run, args.fps)
+    print("%d frames over %.1f s, path seen in %d" % (len(times), times[-1] - times[0], found.sum()))
+    steps = error_steps(times, x, found)
+
+    gains = np.array(list(itertools.product(args.kp, args.ki, args.kd)))
+    forward = np.zeros(len(gains))
+    kp = np.column_stack([forward + args.forward_kp, gains[:, 0]])
+    ki = np.column_stack([forward, gains[:, 1]])
+    kd = np.column_stack([forward, gains[:, 2]])
+    targets = simulate_pid(times, x, y, found, kp, ki, kd, rate=args.rate, deadband=args.deadband)
+    scores = evaluate(times, targets, steps, band=args.band, full_speed=args.full_speed)
+
+    step_times, step_targets = simulate_steps(times, x, y, found)
+    baseline = evaluate(step_times, step_targets, steps, band=args.band, full_speed=args.full_speed)
+
+    print("  %-22s %10s %9s %8s %12s" % ("turn kp/ki/kd", "settle s", "commands", "meters", "commands/m"))
+    print("  %-22s %10.2f %9d %8.2f %12.1f" % ("stepping (no PID)", baseline["settle"][0], baseline["commands"][0],
+                                                baseline["meters"][0], baseline["commands_per_meter"][0]))
+    order = np.lexsort((scores["settle"], scores["commands_per_meter"]))
+    for i in order[:args.top]:
+        print("  %-22s %10.2f %9d %8.2f %12.1f" % ("%g/%g/%g" % tuple(gains[i]), scores["settle"][i],
+                                                    scores["commands"][i], scores["meters"][i],
+                                                    scores["commands_per_meter"][i]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import numpy as np
+import cv2 as cv
+
+
+class ScratchBuffers:
+    """
+    Preallocated output arrays for the vision stages, reused from frame to frame so
+    steady state processing allocates nothing. An array is only replaced when the
+    frame size changes
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        """
+        :param name: name of the stage output
+        :param shape: shape the array needs to have
+        :param dtype: type the array needs to have
+        :return: array to write the stage output into, its old contents are left as they were
+        """
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype)
+        return buf
+
+
+class Preprocessor:
+    """
+    Prepares a frame for edge detection: grayscale conversion, optional downscale,
+    optional blur and normalization, all on one channel and written into scratch buffers
+    """
+
+    def __init__(self, grayscale=True, downscale=1, blur=None, dilate=(2, 2)):
+        """
+        :param grayscale: convert to one channel before anything else
+        :param downscale: shrink the frame by this factor before the other steps
+        :param blur: (w, h) size of the Gaussian blur, None to skip it
+        :param dilate: (w, h) size of the structuring element used to thicken the edges
+        """
+        self.grayscale = grayscale
+        self.downscale = downscale
+        self.blur = blur
+        # built once, a uint8 element keeps dilate on its fast path
+        self.kernel = np.ones(dilate, np.uint8)
+
+    def apply(self, image, scratch, roi=None):
+        """
+        :param image: BGR or grayscale frame, non-destructive
+        :param scratch: ScratchBuffers to write the results into
+        :param roi: optional (x, y, w, h) window of the prepared image to normalize and return
+        :return: prepared image, 1/downscale the size of the frame, or the window of it
+        """
+        if self.grayscale and image.ndim == 3:
+            gray = scratch.get("gray", image.shape[:2])
+            cv.cvtColor(image, cv.COLOR_BGR2GRAY, dst=gray)
+            image = gray
+        if self.downscale > 1:
+            h, w = image.shape[:2]
+            small = scratch.get("small", (h // self.downscale, w // self.downscale) + image.shape[2:])
+            cv.resize(image, (small.shape[1], small.shape[0]), dst=small, interpolation=cv.INTER_AREA)
+            image = small
+        if self.blur:
+            blurred = scratch.get("blurred", image.shape)
+            cv.GaussianBlur(image, tuple(self.blur), 0, dst=blurred)
+            image = blurred
+        # normalize image, this is for changing room lighting
+        if roi is None:
+            normalized = scratch.get("normalized", image.shape)
+            cv.normalize(image, normalized, 0, 255, cv.NORM_MINMAX)
+            return normalized
+        # the window is scaled by the range of the whole frame, like NORM_MINMAX does, so its
+        # pixels are the same as in the normalized frame and the edges found in it don't change
+        low, high = cv.minMaxLoc(image.reshape(image.shape[0], -1))[:2]
+        scale = 255.0 / (high - low) if high > low else 0.0
+        x, y, w, h = roi
+        window = image[y:y + h, x:x + w]
+        normalized = scratch.get("normalized_window", window.shape)
+        cv.convertScaleAbs(window, normalized, scale, -low * scale)
+        return normalized
+
+
+class AutoCanny:
+    """
+    Picks the Canny thresholds from a running histogram of gradient magnitudes, so the edge
+    count stays steady under changing room lighting instead of relying on the sliders.
+    Gradients are sampled on a coarse grid, and the thresholds only move when the new value
+    is more than the hysteresis away, so they don't jump around from frame to frame
+    """
+
+    # L1 gradient magnitude of a 3x3 Sobel, which is what Canny uses, tops out below this
+    MAX_GRADIENT = 2048
+
+    def __init__(self, edge_fraction=0.015, low_ratio=0.97, grid=4, decay=0.8, hysteresis=8,
+                 bins=256, low=247, high=255):
+        """
+        :param edge_fraction: fraction of pixels whose gradient should be above the high threshold
+        :param low_ratio: low threshold as a fraction of the high one
+        :param grid: sample every grid-th row and column
+        :param decay: weight of the old histogram when a new frame is added, 0 uses only the new frame
+        :param hysteresis: smallest change of the high threshold that is applied
+        :param bins: number of histogram bins
+        :param low: starting low threshold
+        :param high: starting high threshold
+        """
+        self.edge_fraction = edge_fraction
+        self.low_ratio = low_ratio
+        self.grid = grid
+        self.decay = decay
+        self.hysteresis = hysteresis
+        self.bins = bins
+        self.bin_width = self.MAX_GRADIENT // bins
+        self.hist = None
+        self.low = low
+        self.high = high
+        self.updates = 0
+        self.changes = 0
+
+    def sample_gradients(self, image):
+        """
+        :param image: grayscale image, only the first channel of a color image is used
+        :return: L1 gradient magnitudes at the grid points, scaled like a 3x3 Sobel
+        """
+        g = self.grid
+        if image.ndim == 3:
+            image = image[..., 0]
+        h, w = image.shape
+        # only the pixels next to the grid points are read, central differences
+        # times 4 match the Sobel weights
+        rows, cols = (h - 2 + g - 1) // g, (w - 2 + g - 1) // g
+        right = image[1:h - 1:g, 2::g][:rows, :cols].astype(np.int16)
+        left = image[1:h - 1:g, 0:w - 2:g][:rows, :cols].astype(np.int16)
+        below = image[2::g, 1:w - 1:g][:rows, :cols].astype(np.int16)
+        above = image[0:h - 2:g, 1:w - 1:g][:rows, :cols].astype(np.int16)
+        return 4 * (np.abs(right - left) + np.abs(below - above))
+
+    def update(self, image):
+        """
+        Adds a frame to the histogram and moves the thresholds if needed
+        :param image: preprocessed image that Canny will run on
+        :return: (low, high) thresholds to use
+        """
+        mag = self.sample_gradients(image)
+        hist = np.bincount(np.minimum(mag.ravel() // self.bin_width, self.bins - 1),
+                           minlength=self.bins).astype(np.float64)
+        hist /= max(1, mag.size)
+        if self.hist is None:
+            self.hist = hist
+        else:
+            self.hist *= self.decay
+            self.hist += (1 - self.decay) * hist
+        self.updates += 1
+
+        # the high threshold is where the share of stronger gradients drops to edge_fraction
+        above = np.cumsum(self.hist[::-1])[::-1]
+        index = np.searchsorted(-above, -self.edge_fraction)
+        high = int(min(index * self.bin_width, self.MAX_GRADIENT))
+        if abs(high - self.high) > self.hysteresis:
+            self.high = high
+            self.low = int(high * self.low_ratio)
+            self.changes += 1
+        return self.low, self.high
+
+    def metrics(self):
+        """
+        :return: dict of the current thresholds and how often they were updated and changed
+        """
+        return {"canny_low": self.low, "canny_high": self.high,
+                "canny_updates": self.updates, "canny_changes": self.changes}
+
+
+class RoiTracker:
+    """
+    Keeps a window around the path found in the last frame, so the next frame only has to
+    process that region. The window is the bounding box of the path with a margin on every
+    side, so a path that did not move is found whole again. When the path is lost the window
+    grows each frame until it covers the whole image again. Windows are in edge image
+    coordinates, (x, y, w, h)
+    """
+
+    def __init__(self, margin=0.1, grow=2.0):
+        """
+        :param margin: added on every side of the path's bounding box as a fraction of the image size,
+                       how far the path can move between frames and still be found whole
+        :param grow: how much the window grows each frame the path is not found in it
+        """
+        self.margin = margin
+        self.grow = grow
+        self.roi = None
+        # (height, width) of the edge image the window was made for
+        self.shape = None
+        self.hits = 0
+        self.misses = 0
+
+    def window(self, shape=None):
+        """
+        :param shape: (height, width) of the next edge image, the window is dropped if it was
+                      made for an image of another size
+        :return: window to process next, None for the whole image
+        """
+        if shape is not None and tuple(shape[:2]) != self.shape:
+            self.roi = None
+        return self.roi
+
+    @staticmethod
+    def _place(cx, cy, w, h, img_w, img_h):
+        # keep the window its full size by sliding it inside the image
+        w, h = min(w, img_w), min(h, img_h)
+        x = int(min(max(cx - w // 2, 0), img_w - w))
+        y = int(min(max(cy - h // 2, 0), img_h - h))
+        return x, y, w, h
+
+    def update(self, found, box, shape):
+        """
+        Moves the window for the next frame
+        :param found: True if the path was found in this frame
+        :param box: (x, y, w, h) bounding box of the path in image coordinates, see path_box,
+                    ignored if not found
+        :param shape: (height, width) of the whole edge image
+        :return:
+        """
+        img_h, img_w = shape[:2]
+        self.shape = (img_h, img_w)
+        if found:
+            self.hits += 1
+            x, y, w, h = box
+            dx, dy = int(img_w * self.margin), int(img_h * self.margin)
+            x0, y0 = max(0, x - dx), max(0, y - dy)
+            x1, y1 = min(img_w, x + w + dx), min(img_h, y + h + dy)
+            if x1 - x0 >= img_w and y1 - y0 >= img_h:
+                # the path fills the image, a window would only add work
+                self.roi = None
+            else:
+                self.roi = (x0, y0, x1 - x0, y1 - y0)
+        elif self.roi is not None:
+            self.misses += 1
+            x, y, w, h = self.roi
+            w, h = int(w * self.grow), int(h * self.grow)
+            if w >= img_w and h >= img_h:
+                self.roi = None
+            else:
+                self.roi = self._place(x + self.roi[2] // 2, y + self.roi[3] // 2, w, h, img_w, img_h)
+
+
+def path_box(bin_img, roi=None):
+    """
+    :param bin_img: a binary image of the path
+    :param roi: optional (x, y, w, h) region to search, defaults to the whole image
+    :return: (x, y, w, h) bounding box of the non-zero pixels in full image coordinates,
+             w and h are 0 if there are none
+    """
+    x0, y0 = 0, 0
+    if roi is not None:
+        x0, y0, w, h = roi
+        bin_img = bin_img[y0:y0 + h, x0:x0 + w]
+    x, y, w, h = cv.boundingRect(bin_img)
+    return x + x0, y + y0, w, h
+
+
+def find_centroid(bin_img, roi=None, stride=1, scratch=None):
+    """
+    Finds the Center of Gravity of the white pixels in a binary image using image moments
+    instead of visiting every pixel from Python
+    :param bin_img: a binary image, anything above 255/2 is taken as white
+    :param roi: optional (x, y, w, h) region to search, defaults to the whole image
+    :param stride: only sample every stride-th row and column of the region
+    :param scratch: optional ScratchBuffers to threshold the image into
+    :return: (cog_x, cog_y, number, area) where the COG is in full image coordinates,
+             number is the count of sampled white pixels and area is the count of sampled pixels
+    """
+    x0, y0 = 0, 0
+    if roi is not None:
+        x0, y0, w, h = roi
+        bin_img = bin_img[y0:y0 + h, x0:x0 + w]
+    if stride > 1:
+        bin_img = bin_img[::stride, ::stride]
+    area = bin_img.shape[0] * bin_img.shape[1]
+
+    # binary image so anything with a high value is taken as white
+    if scratch is not None and stride == 1:
+        mask = scratch.get("centroid_mask", bin_img.shape)
+        cv.threshold(bin_img, 255 // 2, 1, cv.THRESH_BINARY, dst=mask)
+    else:
+        mask = np.ascontiguousarray(bin_img > 255 / 2).view(np.uint8)
+    m = cv.moments(mask, binaryImage=True)
+    number = int(m["m00"])
+    if number == 0:
+        return 0.0, 0.0, 0, area
+    cog_x = m["m10"] / number * stride + x0
+    cog_y = m["m01"] / number * stride + y0
+    return cog_x, cog_y, number, area
+
+
+def detect_face(cascade, gray, near=None):
+    """
+    Runs a Haar cascade on a frame and picks the biggest face
+    :param cascade: cv.CascadeClassifier
+    :param gray: grayscale frame
+    :param near: optional last known face as (x, y, w, h). The region around it is searched
+                 first at scales close to its size, the whole frame only if nothing is found there
+    :return: (face, where) with the face as (x, y, w, h) or None, and where as "near", "full" or None
+    """
+    if near is not None:
+        x, y, w, h = expand_box(near, 1.0, gray.shape)
+        faces = cascade.detectMultiScale(
+            gray[y:y + h, x:x + w], scaleFactor=1.1, minNeighbors=5,
+            minSize=(int(near[2] * 0.7), int(near[3] * 0.7)),
+            maxSize=(int(near[2] * 1.5), int(near[3] * 1.5)))
+        if len(faces):
+            return biggest_box(faces, x, y), "near"
+    faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    if len(faces):
+        return biggest_box(faces, 0, 0), "full"
+    return None, None
+
+
+def biggest_box(boxes, x0=0, y0=0):
+    """
+    :param boxes: (x, y, w, h) boxes
+    :param x0: added to x, for boxes found in a region
+    :param y0: added to y
+    :return: the box with the largest area as a tuple of ints
+    """
+    x, y, w, h = max(boxes, key=lambda b: b[2] * b[3])
+    return (int(x) + x0, int(y) + y0, int(w), int(h))
+
+
+def expand_box(box, margin, shape):
+    """
+    :param box: (x, y, w, h)
+    :param margin: added on every side as a fraction of the box size
+    :param shape: shape of the frame to clip to
+    :return: the expanded box, clipped to the frame
+    """
+    x, y, w, h = box
+    dx, dy = int(w * margin), int(h * margin)
+    x0, y0 = max(0, x - dx), max(0, y - dy)
+    x1, y1 = min(shape[1], x + w + dx), min(shape[0], y + h + dy)
+    return (x0, y0, x1 - x0, y1 - y0)
@@ -0,0 +1,261 @@
+import collections
+import multiprocessing
+import queue
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+
+def _worker(tasks, results, cascade_name):
+    """
+    Runs in each worker process: reads frames out of shared memory and detects faces in them
+    :param tasks: queue of (seq, memory name, slot, shape, near), None to stop
+    :param results: queue the (seq, memory name, slot, face, where) results go to
+    :param cascade_name: Haar cascade to load
+    """
+    import cv2 as cv
+    import resources
+    from vision import detect_face
+    # the pool provides the parallelism, more OpenCV threads per worker only compete with it
+    cv.setNumThreads(1)
+    cascade = resources.cascade(cascade_name)
+    memory = None
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            seq, name, slot, shape, near = task
+            if memory is None or memory.name != name:
+                if memory is not None:
+                    memory.close()
+                memory = shared_memory.SharedMemory(name)
+            image = np.ndarray(shape, np.uint8, memory.buf, offset=slot * int(np.prod(shape)))
+            gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image.copy()
+            # no views may be left when the memory is closed
+            del image
+            face, where = detect_face(cascade, gray, near)
+            results.put((seq, name, slot, face, where))
+    finally:
+        if memory is not None:
+            memory.close()
+
+
+class VisionPool:
+    """
+    Runs face detection on frames in several worker processes, so it isn't limited to the one
+    core the GIL allows
+
+    Frames are copied into slots of a shared memory block and only the slot number goes to a
+    worker, so no pixels are pickled. Results come back in frame order. A frame that falls more
+    than max_lag frames behind the newest finished one is skipped and its result dropped when
+    it arrives, and a frame that comes in while every slot is busy is not submitted at all.
+    A frame of a different size gets a new shared block, the old one is freed once the frames
+    still in it come back.
+
+    The workers are started with fork in the constructor, so create the pool before starting
+    any threads, such as the camera's
+    """
+
+    def __init__(self, workers=3, slots=None, max_lag=None, cascade="haarcascade_frontalface_default.xml"):
+        """
+        :param workers: number of worker processes
+        :param slots: number of frame slots, at least workers + 1, defaults to workers + 2 so one
+                      frame can wait while every worker is busy and another is shown
+        :param max_lag: frames the oldest unfinished frame may fall behind before it is skipped,
+                        defaults to workers
+        :param cascade: Haar cascade the workers load
+        """
+        self.workers = workers
+        self.slots = max(slots or workers + 2, workers + 1)
+        self.max_lag = max_lag or workers
+        context = multiprocessing.get_context("fork")
+        # started before the fork so the workers share it, a tracker of their own would
+        # unlink the shared frames when the worker exits
+        resource_tracker.ensure_running()
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [context.Process(target=_worker, args=(self.tasks, self.results, cascade),
+                                          name="vision-%d" % i, daemon=True)
+                          for i in range(workers)]
+        for process in self.processes:
+            process.start()
+        # the shared frames are made with the first frame, when the size is known
+        self.memory = None
+        self.frames = None
+        self.shape = None
+        self.free = collections.deque()
+        # memory name -> [memory, frames, slots in use] of blocks made for an earlier frame size
+        self.retired = {}
+        # seq -> slot of submitted frames without a result yet
+        self.waiting = {}
+        # seq -> (memory name, slot, face, where) of results that came back before an earlier frame
+        self.done = {}
+        self.next_seq = 0
+        self.next_result = 0
+        self.held_slot = None
+        self.submitted = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    def _allocate(self, shape):
+        if self.memory is not None:
+            # frames in the workers or handed out by get keep the old block until they come back
+            in_use = self.slots - len(self.free)
+            self.free.clear()
+            if in_use:
+                self.retired[self.memory.name] = [self.memory, self.frames, in_use]
+            else:
+                self.frames = None
+                self._free_memory(self.memory)
+        self.shape = shape
+        self.memory = shared_memory.SharedMemory(create=True, size=self.slots * int(np.prod(shape)))
+        self.frames = np.ndarray((self.slots,) + shape, np.uint8, self.memory.buf)
+        self.free.extend(range(self.slots))
+
+    @staticmethod
+    def _free_memory(memory):
+        memory.unlink()
+        try:
+            memory.close()
+        except BufferError:
+            # a frame handed out by get is still referenced, the mapping goes when it does
+            pass
+
+    def _frame(self, name, slot):
+        if name == self.memory.name:
+            return self.frames[slot]
+        return self.retired[name][1][slot]
+
+    def _release(self, name, slot):
+        """
+        Gives a slot back once its frame is done with
+        :param name: name of the shared block the slot is in
+        :param slot: slot number in the block
+        :return:
+        """
+        if name == self.memory.name:
+            self.free.append(slot)
+            return
+        block = self.retired[name]
+        block[2] -= 1
+        if block[2] == 0:
+            # the last frame of an earlier size is done with, so is its block
+            del self.retired[name]
+            block[1] = None
+            self._free_memory(block[0])
+
+    def submit(self, image, near=None):
+        """
+        Copies a frame into a free slot and queues it for a worker
+        :param image: BGR or grayscale frame
+        :param near: last known face, see vision.detect_face
+        :return: sequence number of the frame, or None if every slot was busy and it was dropped
+        """
+        if self.frames is None or image.shape != self.shape:
+            self._allocate(image.shape)
+        self._collect(block=False)
+        if not self.free:
+            self.dropped += 1
+            return None
+        slot = self.free.popleft()
+        self.frames[slot][...] = image
+        seq = self.next_seq
+        self.next_seq += 1
+        self.waiting[seq] = slot
+        self.submitted += 1
+        self.tasks.put((seq, self.memory.name, slot, image.shape, near))
+        return seq
+
+    def _collect(self, block, timeout=None):
+        """
+        Moves finished results off the result queue
+        :param block: wait for at least one result
+        :param timeout: seconds to wait when blocking
+        :return: True if any result was collected
+        """
+        collected = False
+        while True:
+            try:
+                seq, name, slot, face, where = self.results.get(block and not collected, timeout)
+            except queue.Empty:
+                return collected
+            collected = True
+            if seq in self.waiting:
+                del self.waiting[seq]
+                self.done[seq] = (name, slot, face, where)
+            else:
+                # this frame was skipped, its result is stale
+                self._release(name, slot)
+
+    def _skip_stale(self):
+        newest = max(self.done) if self.done else None
+        while (self.next_result in self.waiting and newest is not None
+               and newest - self.next_result >= self.max_lag):
+            # the slot goes back to the free list when the late result arrives
+            del self.waiting[self.next_result]
+            self.skipped += 1
+            self.next_result += 1
+
+    def get(self, timeout=0):
+        """
+        Gets the result of the next frame in order. The frame it returns stays valid until the
+        next call of get
+        :param timeout: seconds to wait for it, None waits as long as frames are in the workers
+        :return: (seq, frame, face, where) or None if it is not ready
+        """
+        if self.held_slot is not None:
+            self._release(*self.held_slot)
+            self.held_slot = None
+        self._collect(block=False)
+        while True:
+            self._skip_stale()
+            if self.next_result in self.done:
+                seq = self.next_result
+                name, slot, face, where = self.done.pop(seq)
+                self.next_result += 1
+                self.held_slot = (name, slot)
+                return seq, self._frame(name, slot), face, where
+            if not self.waiting or timeout == 0:
+                return None
+            if not self._collect(block=True, timeout=timeout):
+                return None
+
+    def map(self, frames, near=lambda: None):
+        """
+        Sends frames through the workers and gives back their results in order
+        :param frames: iterable of frames
+        :param near: function returning the last known face when a frame is submitted
+        :return: generator of (frame, face, where), each frame is valid until the next one is asked for
+        """
+        for image in frames:
+            self.submit(image, near())
+            result = self.get()
+            while result is not None:
+                yield result[1:]
+                result = self.get()
+        result = self.get(timeout=None)
+        while result is not None:
+            yield result[1:]
+            result = self.get(timeout=None)
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(2.0)
+            if process.is_alive():
+                process.terminate()
+        if self.memory is not None:
+            self.frames = None
+            self._free_memory(self.memory)
+            self.memory = None
+        for block in self.retired.values():
+            block[1] = None
+            self._free_memory(block[0])
+        self.retired.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()